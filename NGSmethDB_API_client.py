@@ -2,24 +2,1909 @@
 
 '''
 NGSmethDB website: http://bioinfo2.ugr.es:8080/NGSmethDB/
+
+The module can be imported as a library: NGSmethDBClient queries the API and
+RegionRun downloads a set of regions into an output directory, both without
+the command line interface or its Zenity/dialog front end.
 '''
 
+import os, sys, io, time, json, itertools, collections, math, functools, threading, logging, urllib.parse, concurrent.futures, random, datetime, email.utils, hashlib, gzip, tempfile, glob, bisect, codecs, zlib, struct, array, cProfile, pstats, heapq, shutil, filecmp, importlib, socket
+import requests, requests.adapters
+
+logger = logging.getLogger('NGSmethDB API Client')
+
+__version__ = '0.2.0'
+
+DEFAULT_SERVER = 'http://bioinfo2.ugr.es:8888/NGSmethAPI'
+DEFAULT_CATALOG_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'NGSmethDB_API_client')
+
+MEASURES = ('average', 'stdev', 'p10', 'p25', 'p50', 'p75', 'p90')
+
+def summarize(counts):
+    '''
+    Summary statistics of a sample from its histogram of methylation ratios
+    (counts of 0.0, 0.1, ..., 1.0). Ratios are rounded to one decimal before
+    counting, so the histogram holds the whole distribution and every
+    statistic is exact without keeping or sorting the individual values.
+    '''
+    total = sum(counts)
+    if not total:
+        return None
+    mean = sum(count * n for n, count in enumerate(counts)) / (10 * total)
+    stdev = math.sqrt(sum(count * (n / 10 - mean) ** 2 for n, count in enumerate(counts)) / (total - 1)) if total >= 2 else None
+    cumulative = list(itertools.accumulate(counts))
+    def quantile(percent):
+        k = (total - 1) * percent
+        f = math.floor(k)
+        c = math.ceil(k)
+        value_f = bisect.bisect_right(cumulative, f) / 10
+        if f == c:
+            return value_f
+        value_c = bisect.bisect_right(cumulative, c) / 10
+        return value_f * (c - k) + value_c * (k - f)
+    return dict(zip(MEASURES, [mean, stdev, quantile(0.1), quantile(0.25), quantile(0.5), quantile(0.75), quantile(0.9)]))
+
+class RunStats:
+    '''
+    Methylation ratio histograms of the whole run per context and sample.
+    Histograms are merged by adding them up, so regions can be added in any
+    order, from any thread, and the states of separate runs can be combined.
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add(self, histograms):
+        with self.lock:
+            for context, counts_by_sample in histograms.items():
+                for sample, counts in counts_by_sample.items():
+                    total = self.histograms.setdefault(context, {}).setdefault(sample, [0] * 11)
+                    for n, count in enumerate(counts):
+                        total[n] += count
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path + '.part', 'wt') as handle:
+            json.dump(self.histograms, handle)
+        os.replace(path + '.part', path)
+
+    def load(self, path):
+        with open(path, 'rt') as handle:
+            self.add(json.load(handle))
+
+    def write(self, directory, samples):
+        os.makedirs(directory, exist_ok = True)
+        contexts = sorted(self.histograms)
+        with open(os.path.join(directory, 'run_summary_stat.tsv'), 'wt') as handle:
+            handle.write('\t'.join(['#context', 'measure'] + samples) + '\n')
+            for context in contexts:
+                histograms = [self.histograms[context].get(sample, [0] * 11) for sample in samples]
+                line = [context, 'count'] + [sum(counts) for counts in histograms]
+                handle.write('\t'.join(str(value) for value in line) + '\n')
+                summaries = [summarize(counts) for counts in histograms]
+                for measure in MEASURES:
+                    line = [context, measure] + [summary[measure] if summary else None for summary in summaries]
+                    line = [str(value) if value else '.' for value in line]
+                    handle.write('\t'.join(line) + '\n')
+        with open(os.path.join(directory, 'run_histogram.tsv'), 'wt') as handle:
+            handle.write('\t'.join(['#context', 'methRatio'] + samples) + '\n')
+            for context in contexts:
+                for n in range(0, 11, 1):
+                    line = [context, n / 10] + [self.histograms[context].get(sample, [0] * 11)[n] for sample in samples]
+                    handle.write('\t'.join(str(value) for value in line) + '\n')
+
+class Counters:
+    '''
+    Named counters (requests, retries, statuses, bytes, seconds...) that any
+    number of threads can add to, and the time they were created at.
+    '''
+
+    def __init__(self):
+        self.values = collections.Counter()
+        self.lock = threading.Lock()
+        self.created = time.perf_counter()
+
+    def add(self, name, value = 1):
+        with self.lock:
+            self.values[name] += value
+
+    def merge(self, other):
+        values = other.snapshot()
+        with self.lock:
+            self.values.update(values)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+# Phases of a query: waiting for its responses, waiting for the rate and
+# concurrency limits of the client, HTTP requests (with --stream, including
+# parsing), JSON parsing, building rows, statistics and file output
+PHASES = ('wait', 'throttle', 'request', 'parse', 'transform', 'stats', 'write')
+METRICS = ('seconds',) + PHASES + ('bytes', 'requests', 'retries')
+
+def percentile_of(values, percent):
+    '''
+    Nearest-rank percentile of a sorted sequence.
+    '''
+    if not values:
+        return None
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+class RunMetrics:
+    '''
+    Timings and transfer counters of every query of a run. A line per query
+    goes to region_metrics.tsv as soon as it finishes; close() writes the
+    distribution of every metric (total and percentiles) to run_metrics.json.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.columns = dict((metric, array.array('d')) for metric in METRICS)
+        self.failed = 0
+        self.handle = None
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def add(self, query, regions, failed, values):
+        with self.lock:
+            if self.handle is None:
+                os.makedirs(self.directory, exist_ok = True)
+                self.handle = open(os.path.join(self.directory, 'region_metrics.tsv'), 'wt')
+                self.handle.write('\t'.join(('#chrom', 'start', 'end', 'regions', 'status') + METRICS) + '\n')
+            self.failed += failed
+            line = [query[0], str(int(query[1]) - 1), query[2], str(len(regions)), 'failed' if failed else 'ok']
+            for metric in METRICS:
+                value = values.get(metric, 0)
+                self.columns[metric].append(value)
+                line.append('{:.6f}'.format(value) if metric == 'seconds' or metric in PHASES else str(int(value)))
+            self.handle.write('\t'.join(line) + '\n')
+
+    def load(self, path):
+        '''
+        Adds the lines of a region_metrics.tsv (e.g. of another run).
+        '''
+        with open(path, 'rt') as handle:
+            header = handle.readline().rstrip('\n').split('\t')
+            for line in handle:
+                fields = line.rstrip('\n').split('\t')
+                values = dict((metric, float(value)) for metric, value in zip(header[5:], fields[5:]))
+                self.add((fields[0], str(int(fields[1]) + 1), fields[2]), [None] * int(fields[3]), fields[4] == 'failed', values)
+
+    def summary(self, counters, elapsed = None):
+        with self.lock:
+            metrics = {}
+            for metric, values in self.columns.items():
+                values = sorted(values)
+                metrics[metric] = {'total': sum(values), 'p50': percentile_of(values, 50), 'p90': percentile_of(values, 90),
+                                   'p99': percentile_of(values, 99), 'max': values[-1] if values else None}
+            return {'elapsed': time.monotonic() - self.started if elapsed is None else elapsed, 'queries': len(self.columns['seconds']), 'failed': self.failed,
+                    'client': counters, 'metrics': metrics}
+
+    def close(self, counters, elapsed = None):
+        '''
+        Writes run_metrics.json and returns the summary it holds.
+        '''
+        summary = self.summary(counters, elapsed)
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+        os.makedirs(self.directory, exist_ok = True)
+        with open(os.path.join(self.directory, 'run_metrics.json'), 'wt') as handle:
+            json.dump(summary, handle, indent = 2)
+        return summary
+
+def format_summary(summary):
+    '''
+    Lines of a human readable run summary.
+    '''
+    client = summary['client']
+    statuses = ', '.join('{}: {}'.format(name[7:], count) for name, count in sorted(client.items()) if name.startswith('status_'))
+    lines = ['{} queries ({} failed) in {:.1f} s. {} requests ({}), {} retries, {} connection errors, {} cache hits, {:.1f} MB received'.format(
+        summary['queries'], summary['failed'], summary['elapsed'], client.get('requests', 0), statuses or 'no responses', client.get('retries', 0),
+        client.get('connection_errors', 0), client.get('cache_hits', 0), client.get('bytes', 0) / 2 ** 20)]
+    lines.append('{:<10} {:>10} {:>9} {:>9} {:>9} {:>9}'.format('metric (s)', 'total', 'p50', 'p90', 'p99', 'max'))
+    for metric in ('seconds',) + PHASES:
+        values = summary['metrics'][metric]
+        if values['max'] is None:
+            continue
+        lines.append('{:<10} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(metric, values['total'], values['p50'], values['p90'], values['p99'], values['max']))
+    return lines
+
+class Profiler:
+    '''
+    cProfile of the functions it wraps, in whatever thread they run: every
+    thread gets its own profile, and save() merges them all.
+    '''
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def wrap(self, function):
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            if getattr(self.local, 'active', False):
+                return function(*args, **kwargs)
+            if not hasattr(self.local, 'profile'):
+                self.local.profile = cProfile.Profile()
+                with self.lock:
+                    self.profiles.append(self.local.profile)
+            self.local.active = True
+            self.local.profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.profile.disable()
+                self.local.active = False
+        return profiled
+
+    def save(self, path, top = 40):
+        '''
+        Writes the merged profile to path (pstats format) and the top
+        functions by cumulative time to path.txt.
+        '''
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        with open(path + '.txt', 'wt') as handle:
+            stats = pstats.Stats(*profiles, stream = handle)
+            stats.dump_stats(path)
+            stats.sort_stats('cumulative').print_stats(top)
+
+def config_parser(configfile):
+    data = json.load(configfile)
+    return data['assembly'], data['samples']
+
+def make_outdir(output):
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+class BEDError(ValueError):
+    pass
+
+def region_key(region):
+    return region[0], int(region[1]), int(region[2])
+
+def open_bed(path):
+    '''
+    Text handle of a plain or gzip/bgzip compressed BED file ('-' for stdin).
+    '''
+    raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if not hasattr(raw, 'peek'):
+        raw = io.BufferedReader(raw)
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        raw = gzip.GzipFile(fileobj = raw, mode = 'rb')
+    return io.TextIOWrapper(raw, encoding = 'utf-8', errors = 'replace')
+
+def read_bed(path, sort = False):
+    '''
+    Regions (chrom, start, end) of a BED file, with 1-based inclusive bounds,
+    read in a single pass. Header (track, browser) and comment lines are
+    skipped; invalid lines raise a BEDError with their line number. With
+    sort, regions are sorted by chromosome and position and deduplicated.
+    '''
+    regions = []
+    with open_bed(path) as handle:
+        for number, line in enumerate(handle, 1):
+            line = line.rstrip('\r\n')
+            if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                continue
+            fields = line.split('\t') if '\t' in line else line.split()
+            if len(fields) < 3:
+                raise BEDError('line {}: expected at least 3 fields (chrom, start, end)'.format(number))
+            try:
+                start, end = int(fields[1]), int(fields[2])
+            except ValueError:
+                raise BEDError('line {}: start and end must be integers'.format(number))
+            if start < 0 or end <= start:
+                raise BEDError('line {}: invalid interval {}-{}'.format(number, start, end))
+            regions.append((fields[0], str(start + 1), str(end)))
+    if sort:
+        regions = sorted(set(regions), key = region_key)
+    return regions
+
+class APIError(Exception):
+    pass
+
+Assembly = collections.namedtuple('Assembly', ['assembly', 'common', 'species'])
+
+class Sample(collections.namedtuple('Sample', ['individual', 'sample'])):
+    '''
+    Sample of an assembly. str() gives its ID (individual.sample), as used in
+    configuration files and queries.
+    '''
+    __slots__ = ()
+
+    def __str__(self):
+        return '.'.join(self)
+
+class HostLimit:
+    '''
+    Admission of the requests to a host: at most limit of them in flight,
+    started at no more than rate per second (a token bucket of burst tokens;
+    rate 0: no rate limit). With adaptive, limit follows AIMD between 1 and
+    maximum: it starts at half the maximum, grows by one for every limit
+    healthy responses and halves on a 429 or 5xx status, a connection error
+    or a latency spike (time to the response headers over latency_factor
+    times its moving average), at most once per latency window.
+    '''
+
+    def __init__(self, maximum, rate = 0, burst = None, adaptive = False, latency_factor = 3):
+        self.maximum = maximum
+        self.limit = float(max(1, maximum // 2) if adaptive else maximum)
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.adaptive = adaptive
+        self.latency_factor = latency_factor
+        self.latency = None
+        self.decreased = 0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        '''
+        Waits for a request slot and, with a rate, a token. Returns the
+        seconds waited.
+        '''
+        started = time.monotonic()
+        delay = 0
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            if self.rate:
+                # Tokens can go negative: each request reserves its own and waits for it
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate) - 1
+                self.refilled = now
+                if self.tokens < 0:
+                    delay = -self.tokens / self.rate
+        if delay:
+            time.sleep(delay)
+        return time.monotonic() - started
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def feedback(self, status, latency):
+        '''
+        Adapts the limit to the outcome of a request: its status (None for a
+        connection error) and its time to the response headers.
+        '''
+        if not self.adaptive:
+            return
+        with self.condition:
+            if status is None:
+                congested = 'connection error'
+            elif status == 429 or status >= 500:
+                congested = 'status {}'.format(status)
+            else:
+                congested = None
+                if self.latency is not None and latency > self.latency_factor * self.latency:
+                    congested = 'latency {:.2f} s'.format(latency)
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+            now = time.monotonic()
+            if congested:
+                if now - self.decreased >= 2 * max(self.latency or 0, 0.05):
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = now
+                    logger.info('Server congestion ({}). Requests in flight limited to {}'.format(congested, int(self.limit)))
+            elif self.limit < self.maximum:
+                slots = int(self.limit)
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                if int(self.limit) > slots:
+                    logger.info('Requests in flight limited to {}'.format(int(self.limit)))
+                    self.condition.notify()
+
+class NGSmethDBClient:
+    '''
+    Headless client of the NGSmethDB API. An instance can be shared by any
+    number of threads: requests go through one keep-alive session, at most
+    host_connections at a time per host (and at most rate per second, or
+    with adaptive, fewer while the server shows congestion; see HostLimit),
+    and failed ones are retried with exponential backoff. With cache_dir, responses are also cached on disk.
+    With catalog_dir, the catalog (assemblies, samples, version) is kept on
+    disk and revalidated with conditional requests every catalog_ttl seconds.
+    Regions are (chrom, start, end) tuples with 1-based, inclusive bounds;
+    those longer than chunk_size bp are queried in chunks, chunk_jobs at a
+    time, and stitched back together. Requests, retries, response statuses,
+    bytes and seconds spent are added up in counters (and in the counters
+    given to a query, if any).
+    '''
+
+    def __init__(self, server = DEFAULT_SERVER, connect_timeout = 10, read_timeout = 120, retries = 10, backoff = 0.5, backoff_max = 60,
+                 retry_statuses = (429, 500, 502, 503, 504), host_connections = 4, cache_dir = None, cache_size = 1024, cache_ttl = 604800,
+                 offline = False, stream = False, catalog_dir = None, catalog_ttl = 3600, chunk_size = 1000000, chunk_jobs = 1,
+                 rate = 0, burst = None, adaptive = False):
+        if offline and not cache_dir:
+            raise ValueError('offline mode requires a cache directory')
+        self.server = server
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.retry_statuses = set(retry_statuses)
+        self.host_connections = host_connections
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.offline = offline
+        self.stream = stream
+        self.catalog_dir = catalog_dir
+        self.catalog_ttl = catalog_ttl
+        self.chunk_size = chunk_size
+        self.chunk_jobs = chunk_jobs
+        self.rate = rate
+        self.burst = burst
+        self.adaptive = adaptive
+        self.host_limits = {}
+        self.host_limits_lock = threading.Lock()
+        self.cache_lock = threading.Lock()
+        self.cache_written = 0
+        self.counters = Counters()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = host_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def assemblies(self):
+        data = self.catalog(os.path.join(self.server, 'info'), ('info', self.server))
+        return [Assembly(a['assembly'], a['common'], a['species']) for a in data]
+
+    def samples(self, assembly):
+        data = self.catalog(os.path.join(self.server, assembly, 'samples'), ('samples', self.server, assembly))
+        return [Sample(individual, sample) for individual in sorted(data) for sample in sorted(data[individual])]
+
+    def version(self):
+        '''
+        Latest version of this client published by the server, as a list of ints.
+        '''
+        data = self.catalog(os.path.join(self.server, 'version'), ('version', self.server))
+        return data[0]['NGSmethDB_API_client']
+
+    def unknown_samples(self, assembly, samples):
+        '''
+        The samples (IDs) not found in the catalog. An unknown assembly raises
+        a ValueError.
+        '''
+        assemblies = [a.assembly for a in self.assemblies()]
+        if assembly not in assemblies:
+            raise ValueError('Unknown assembly {} (available: {})'.format(assembly, ', '.join(assemblies)))
+        catalog = set(str(sample) for sample in self.samples(assembly))
+        return [str(sample) for sample in samples if str(sample) not in catalog]
+
+    def catalog(self, url, key):
+        if not self.catalog_dir:
+            return self.get(url, key)
+        path = os.path.join(self.catalog_dir, hashlib.sha256(json.dumps(key).encode()).hexdigest() + '.json')
+        try:
+            with open(path, 'rt') as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and (self.offline or time.time() - entry['checked'] < self.catalog_ttl):
+            return entry['data']
+        if self.offline:
+            raise APIError('No cached catalog for {} (offline mode)'.format(url))
+        headers = {}
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            res = self.request(url, headers = headers)
+            data = self.decode(res, url) if res.status_code != 304 else None
+        except APIError as error:
+            if entry is None:
+                raise
+            logger.warning('Unable to refresh the catalog ({}). Using the cached one.'.format(error))
+            return entry['data']
+        if res.status_code == 304:
+            logger.info('Catalog not modified: ' + url)
+        else:
+            entry = {'url': url, 'etag': res.headers.get('ETag'), 'last_modified': res.headers.get('Last-Modified'), 'data': data}
+        entry['checked'] = time.time()
+        os.makedirs(self.catalog_dir, exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = self.catalog_dir, suffix = '.part')
+        with os.fdopen(fd, 'wt') as handle:
+            json.dump(entry, handle)
+        os.replace(tmp, path)
+        return entry['data']
+
+    def region(self, assembly, region, samples, counters = None):
+        '''
+        Methylation records (one dict per position) of the samples in a region.
+        '''
+        samples = [str(sample) for sample in samples]
+        def fetch(chunk):
+            url = os.path.join(self.server, assembly, chunk[0] + ":" + chunk[1] + "-" + chunk[2] + '?samples=' + ",".join(samples))
+            logger.info('Methylation Levels and DMCs - GET: ' + url)
+            return self.fetch(url, ('region', self.server, assembly, chunk, sorted(samples)), counters)
+        return self.fetch_chunks(self.chunks(region), fetch)
+
+    def segments(self, assembly, region, percentile = '95', counters = None):
+        '''
+        Methylation segments (one dict per segment) overlapping a region.
+        '''
+        def fetch(chunk):
+            url = os.path.join(os.path.join(self.server, 'segments', str(percentile)), assembly, chunk[0] + ":" + chunk[1] + "-" + chunk[2])
+            logger.info('Methylation segments - GET: ' + url)
+            return self.fetch(url, ('segments', self.server, assembly, chunk, str(percentile)), counters)
+        chunks = self.chunks(region)
+        if len(chunks) == 1:
+            return fetch(chunks[0])
+        return unique_segments(self.fetch_chunks(chunks, fetch))
+
+    def chunks(self, region):
+        start, end = int(region[1]), int(region[2])
+        if not self.chunk_size or end - start + 1 <= self.chunk_size:
+            return [(region[0], str(start), str(end))]
+        return [(region[0], str(chunk), str(min(end, chunk + self.chunk_size - 1))) for chunk in range(start, end + 1, self.chunk_size)]
+
+    def fetch_chunks(self, chunks, fetch):
+        '''
+        Records of fetch(chunk) for every chunk, in order. With chunk_jobs,
+        the next chunks are downloaded while the current one is consumed.
+        '''
+        if len(chunks) == 1:
+            return fetch(chunks[0])
+        if self.chunk_jobs <= 1:
+            return itertools.chain.from_iterable(map(fetch, chunks))
+        return itertools.chain.from_iterable(prefetch(lambda chunk: list(fetch(chunk)), chunks, self.chunk_jobs))
+
+    def fetch(self, url, key, counters = None):
+        if self.stream:
+            return self.get_stream(url, key, counters)
+        return self.get(url, key, counters) or []
+
+    def count(self, counters, name, value = 1):
+        self.counters.add(name, value)
+        if counters is not None:
+            counters.add(name, value)
+
+    def host_limit(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self.host_limits_lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = HostLimit(self.host_connections, self.rate, self.burst, self.adaptive)
+            return self.host_limits[host]
+
+    def retry_delay(self, attempt, res = None):
+        if res is not None and 'Retry-After' in res.headers:
+            value = res.headers['Retry-After']
+            try:
+                return max(0, float(value))
+            except ValueError:
+                try:
+                    date = email.utils.parsedate_to_datetime(value)
+                    return max(0, (date - datetime.datetime.now(date.tzinfo)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+        delay = min(self.backoff_max, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def request(self, url, stream = False, headers = None, counters = None):
+        '''
+        GET url with retries. A streamed response is returned with its host slot
+        still taken; the caller must close it and release host_limit(url).
+        A conditional request (headers) can also return a 304 response.
+        '''
+        limit = self.host_limit(url)
+        for attempt in range(self.retries):
+            last = attempt == self.retries - 1
+            self.count(counters, 'throttle', limit.acquire())
+            self.count(counters, 'requests')
+            started = time.perf_counter()
+            try:
+                res = self.session.get(url, timeout = (self.connect_timeout, self.read_timeout), stream = stream, headers = headers)
+            except requests.exceptions.RequestException as error:
+                limit.feedback(None, time.perf_counter() - started)
+                limit.release()
+                self.count(counters, 'request', time.perf_counter() - started)
+                self.count(counters, 'connection_errors')
+                if last:
+                    raise APIError('Unable to connect to the NGSmethDB API Server ({})'.format(error))
+                delay = self.retry_delay(attempt)
+                logger.warning('Internet connection failed. Retrying in {:.1f} s...'.format(delay))
+                self.count(counters, 'retries')
+                time.sleep(delay)
+                continue
+            self.count(counters, 'request', time.perf_counter() - started)
+            self.count(counters, 'status_{}'.format(res.status_code))
+            limit.feedback(res.status_code, res.elapsed.total_seconds())
+            if res.status_code == 200 or res.status_code == 304 and headers:
+                if not stream:
+                    limit.release()
+                    self.count(counters, 'bytes', len(res.content))
+                return res
+            res.close()
+            limit.release()
+            if res.status_code not in self.retry_statuses or last:
+                raise APIError('API Error: {} for {}'.format(res.status_code, url))
+            delay = self.retry_delay(attempt, res)
+            logger.warning('API Error: {}. Retrying in {:.1f} s...'.format(res.status_code, delay))
+            self.count(counters, 'retries')
+            time.sleep(delay)
+
+    def get(self, url, key = None, counters = None):
+        if key is not None and self.cache_dir:
+            content = self.cache_get(key)
+            if content is not None:
+                started = time.perf_counter()
+                try:
+                    data = json.loads(content.decode())
+                except ValueError as error:
+                    self.cache_discard(self.cache_path(key), error)
+                else:
+                    self.count(counters, 'cache_hits')
+                    self.count(counters, 'parse', time.perf_counter() - started)
+                    return data
+            if self.offline:
+                raise APIError('No cached response for {} (offline mode)'.format(url))
+        res = self.request(url, counters = counters)
+        started = time.perf_counter()
+        data = self.decode(res, url)
+        self.count(counters, 'parse', time.perf_counter() - started)
+        # Only valid responses are cached
+        if key is not None and self.cache_dir:
+            self.cache_put(key, res.content)
+        return data
+
+    def decode(self, res, url):
+        try:
+            return res.json()
+        except ValueError as error:
+            raise APIError('Invalid response from {} ({})'.format(url, error))
+
+    def get_stream(self, url, key = None, counters = None):
+        '''
+        Records of a response parsed as it is read. The time spent reading and
+        parsing it is counted as 'parse' for cached responses, and as
+        'request' for downloaded ones.
+        '''
+        if key is not None and self.cache_dir:
+            path = self.cache_lookup(key)
+            if path is not None:
+                yielded = 0
+                try:
+                    with gzip.open(path, 'rb') as handle:
+                        self.count(counters, 'cache_hits')
+                        for record in self.timed(iter_json_array(iter(functools.partial(handle.read, 2 ** 16), b'')), counters, 'parse'):
+                            yielded += 1
+                            yield record
+                    return
+                except (OSError, EOFError, ValueError) as error:
+                    self.cache_discard(path, error)
+                    if yielded:
+                        # The records already yielded cannot be taken back, so it is not downloaded again here
+                        raise APIError('Corrupt cached response for {} ({})'.format(url, error))
+            if self.offline:
+                raise APIError('No cached response for {} (offline mode)'.format(url))
+        res = self.request(url, stream = True, counters = counters)
+        received = [0]
+        def counted(chunks):
+            for chunk in chunks:
+                received[0] += len(chunk)
+                yield chunk
+        try:
+            chunks = counted(res.iter_content(chunk_size = 2 ** 16))
+            if key is not None and self.cache_dir:
+                chunks = self.cache_tee(key, chunks)
+            yield from self.timed(iter_json_array(chunks), counters, 'request')
+            for chunk in chunks:
+                pass
+        except requests.exceptions.RequestException as error:
+            raise APIError('Connection lost while reading {} ({})'.format(url, error))
+        except ValueError as error:
+            raise APIError('Invalid response from {} ({})'.format(url, error))
+        finally:
+            res.close()
+            self.host_limit(url).release()
+            self.count(counters, 'bytes', received[0])
+
+    def timed(self, items, counters, name):
+        '''
+        Yields the items, counting the time spent producing them (not the
+        time the consumer holds each one) as name.
+        '''
+        elapsed = 0
+        started = time.perf_counter()
+        try:
+            for item in items:
+                elapsed += time.perf_counter() - started
+                yield item
+                started = time.perf_counter()
+            elapsed += time.perf_counter() - started
+        finally:
+            self.count(counters, name, elapsed)
+
+    def cache_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.json.gz')
+
+    def cache_lookup(self, key):
+        path = self.cache_path(key)
+        try:
+            mtime = os.path.getmtime(path)
+            if self.cache_ttl and time.time() - mtime > self.cache_ttl and not self.offline:
+                return None
+            # mtime keeps the download time for the TTL, atime the last use for the LRU eviction
+            os.utime(path, (time.time(), mtime))
+        except OSError:
+            return None
+        return path
+
+    def cache_get(self, key):
+        path = self.cache_lookup(key)
+        if path is None:
+            return None
+        try:
+            with gzip.open(path, 'rb') as handle:
+                return handle.read()
+        except (OSError, EOFError) as error:
+            self.cache_discard(path, error)
+            return None
+
+    def cache_discard(self, path, error):
+        logger.warning('Discarding corrupt cache entry {} ({})'.format(path, error))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def cache_put(self, key, content):
+        path = self.cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.part')
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(gzip.compress(content, compresslevel = 1))
+        os.replace(tmp, path)
+        self.cache_account(len(content))
+
+    def cache_tee(self, key, chunks):
+        path = self.cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.part')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj = raw, mode = 'wb', compresslevel = 1) as handle:
+                for chunk in chunks:
+                    handle.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+        except BaseException:
+            os.remove(tmp)
+            raise
+        os.replace(tmp, path)
+        self.cache_account(size)
+
+    def cache_account(self, size):
+        with self.cache_lock:
+            self.cache_written += size
+            evict = self.cache_written > self.cache_size * 2 ** 20 / 10
+            if evict:
+                self.cache_written = 0
+        if evict:
+            self.cache_evict()
+
+    def cache_evict(self):
+        if not self.cache_dir:
+            return
+        entries = []
+        size = 0
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                size += stat.st_size
+                if name.endswith('.part'):
+                    # Being written by cache_put/cache_tee, unless no data arrived for longer than
+                    # the read timeout: then it was left by a killed process
+                    if time.time() - stat.st_mtime > 2 * self.read_timeout:
+                        try:
+                            os.remove(path)
+                            size -= stat.st_size
+                        except OSError:
+                            pass
+                    continue
+                entries.append((stat.st_atime, stat.st_size, path))
+        limit = self.cache_size * 2 ** 20
+        for atime, entry_size, path in sorted(entries):
+            if size <= limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+def iter_json_array(chunks):
+    '''
+    Yields the items of the JSON array spread over chunks (bytes) one by one,
+    so that a response never has to be held in memory as a whole.
+    '''
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    opened = False
+    for chunk in itertools.chain(chunks, [None]):
+        buffer = buffer[position:] + (utf8.decode(chunk) if chunk is not None else utf8.decode(b'', final = True))
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if not opened:
+                if buffer[position] != '[':
+                    # Not an array (e.g. an empty object): parse it whole
+                    rest = buffer[position:] + ''.join(utf8.decode(c) for c in chunks)
+                    data = json.loads(rest)
+                    if data:
+                        yield from data
+                    return
+                opened = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if chunk is None:
+                    raise
+                break
+            yield item
+    if not opened:
+        return
+    raise ValueError('Truncated JSON array')
+
+def unique_segments(segments):
+    '''
+    Drops the repeats of segments that span the boundary between two chunks.
+    '''
+    seen = set()
+    for d in segments:
+        key = (d['chrom'], d['start'], d['end'])
+        if key not in seen:
+            seen.add(key)
+            yield d
+
+def prefetch(function, items, jobs):
+    '''
+    Yields function(item) for every item in order, computing up to jobs
+    results ahead in threads.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= jobs:
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+def lookahead(items, n):
+    '''
+    Yields the items of an iterator while keeping n more already taken from
+    it, so that work started by the iterator runs ahead of the consumer.
+    '''
+    pending = collections.deque()
+    for item in items:
+        pending.append(item)
+        if len(pending) > n:
+            yield pending.popleft()
+    yield from pending
+
+def run_regions(batches, jobs, worker, stop = None):
+    '''
+    Yields (batch, worker(batch)) for every batch, running up to jobs workers
+    at a time. Once the stop event is set, no more batches are started and
+    only the ones already running are waited for.
+    '''
+    if stop is not None:
+        batches = itertools.takewhile(lambda batch: not stop.is_set(), batches)
+    if jobs <= 1:
+        for batch in batches:
+            yield batch, worker(batch)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+        pending = {}
+        for batch in batches:
+            if len(pending) >= 2 * jobs:
+                done, _ = concurrent.futures.wait(pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+            pending[executor.submit(worker, batch)] = batch
+        for future in concurrent.futures.as_completed(pending):
+            if stop is not None and stop.is_set():
+                for waiting in pending:
+                    waiting.cancel()
+            if future.cancelled():
+                continue
+            yield pending[future], future.result()
+
+METH_HEADER = '\t'.join(['#chrom', 'pos', 'genotype', 'methContext', 'w_methylatedReads', 'w_coverage', 'w_phredScore', 'c_methylatedReads', 'c_coverage', 'c_phredScore',
+                         'methylatedReads', 'coverage', 'phredScore', 'w_methRatio', 'c_methRatio', 'methRatio']) + '\n'
+DIFFMETH_HEADER = '\t'.join(['chrom', 'pos', 'methContext', 'sample1', 'sample2', 'method', 'pValue', 'consensus']) + '\n'
+SEGMENTS_HEADER = '\t'.join(['#chrom', 'start', 'end', 'methContext', 'sampleCount', 'sample', 'sample.methRatio']) + '\n'
+
+# Per-region TSV layout: path (relative to the output directory) and header of every table
+TSV_TABLES = {
+    'meth': (('meth', '{region}', '{key}.tsv'), METH_HEADER),
+    'diffmeth': (('diffmeth', '{region}', '{key}.tsv'), DIFFMETH_HEADER),
+    'segments': (('segments', '{region}.tsv'), SEGMENTS_HEADER),
+}
+
+# With several percentiles, the segments of each one go to segments/p<NN>/
+TSV_TABLES_PERCENTILES = dict(TSV_TABLES, segments = (('segments', 'p{key}', '{region}.tsv'), SEGMENTS_HEADER))
+
+# Consolidated layout: columns and types of every table
+DATASET_TABLES = {
+    'meth': [('chrom', 'str'), ('pos', 'int'), ('genotype', 'str'), ('methContext', 'str'),
+             ('w_methylatedReads', 'int'), ('w_coverage', 'int'), ('w_phredScore', 'int'),
+             ('c_methylatedReads', 'int'), ('c_coverage', 'int'), ('c_phredScore', 'int'),
+             ('methylatedReads', 'int'), ('coverage', 'int'), ('phredScore', 'int'),
+             ('w_methRatio', 'float'), ('c_methRatio', 'float'), ('methRatio', 'float'), ('sample', 'str'), ('region', 'str')],
+    'diffmeth': [('chrom', 'str'), ('pos', 'int'), ('methContext', 'str'), ('sample1', 'str'), ('sample2', 'str'),
+                 ('method', 'str'), ('pValue', 'float'), ('consensus', 'str'), ('kind', 'str'), ('region', 'str')],
+    'segments': [('chrom', 'str'), ('start', 'int'), ('end', 'int'), ('methContext', 'str'), ('sampleCount', 'int'),
+                 ('sample', 'str'), ('methRatio', 'float'), ('percentile', 'str'), ('region', 'str')],
+    'summary_stat': [('chrom', 'str'), ('region', 'str'), ('sample', 'str'), ('measure', 'str'), ('value', 'float')],
+    'histogram': [('chrom', 'str'), ('region', 'str'), ('sample', 'str'), ('methRatio', 'float'), ('count', 'int')],
+}
+
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+class TimedFile(io.FileIO):
+    '''
+    File adding up the seconds spent in its system writes. Under a buffer,
+    this is the file I/O time of a handle at the cost of a clock read per
+    buffer flush rather than per line.
+    '''
+
+    seconds = 0
+
+    def write(self, data):
+        started = time.perf_counter()
+        written = super().write(data)
+        self.seconds += time.perf_counter() - started
+        return written
+
+class RegionWriter:
+    '''
+    Writes a region in the per-region TSV layout, keeping one open handle per
+    output file. Files are written as <name>.part and only renamed to <name>
+    by commit(). seconds is the time spent writing them so far.
+    '''
+
+    def __init__(self, output, region, layout = TSV_TABLES):
+        self.output = output
+        self.layout = layout
+        self.name = '_'.join(region)
+        self.handles = collections.OrderedDict()
+        self.tables = {}
+        self.directories = set()
+        self.files = []
+
+    @property
+    def seconds(self):
+        return sum(raw.seconds for raw in self.files)
+
+    def open(self, path, header = ''):
+        if path not in self.handles:
+            directory = os.path.dirname(path)
+            if directory not in self.directories:
+                os.makedirs(directory, exist_ok = True)
+                self.directories.add(directory)
+            raw = TimedFile(path + '.part', 'w')
+            self.files.append(raw)
+            handle = io.TextIOWrapper(io.BufferedWriter(raw, buffer_size = 2 ** 16))
+            handle.write(header)
+            self.handles[path] = handle
+        return self.handles[path]
+
+    def table(self, table, key = None):
+        if (table, key) not in self.tables:
+            parts, header = self.layout[table]
+            path = os.path.join(self.output, *[part.format(region = self.name, key = key) for part in parts])
+            self.tables[(table, key)] = self.open(path, header)
+        return self.tables[(table, key)]
+
+    def emitter(self, table, key = None):
+        '''
+        Function writing rows to a table, for hot loops: the handle lookup is
+        done once and the row is formatted inline.
+        '''
+        write = self.table(table, key).write
+        if table == 'segments':
+            return lambda values: write('\t'.join([str(value) for value in values]) + '\n')
+        return lambda values: write('\t'.join([str(value) if value else '.' for value in values]) + '\n')
+
+    def stats(self, samples, summaries, counts):
+        stats = os.path.join(self.output, 'stats', self.name)
+        handle = self.open(os.path.join(stats, 'summary_stat.tsv'), '\t'.join(['#measure'] + samples) + '\n')
+        if any(summaries):
+            for measure in MEASURES:
+                line = [measure] + [summary[measure] if summary else None for summary in summaries]
+                line = [str(value) if value else '.' for value in line]
+                handle.write('\t'.join(line) + '\n')
+        handle = self.open(os.path.join(stats, 'histogram.tsv'), '\t'.join(['#methRatio'] + samples) + '\n')
+        if any(summaries):
+            for n in range(0, 11, 1):
+                line = [str(n / 10)] + [counts[sample][n] for sample in samples]
+                line = [str(value) if value else '0' for value in line]
+                handle.write('\t'.join(line) + '\n')
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+
+    def commit(self, done):
+        self.close()
+        for path in self.handles:
+            os.replace(path + '.part', path)
+        done()
+
+    def discard(self):
+        self.close()
+        for path in self.handles:
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
+
+class DatasetRegion:
+    '''
+    Collects the rows of a region for a DatasetWriter, which writes them
+    (to disk) on commit.
+    '''
+
+    seconds = 0
+
+    def __init__(self, dataset, region):
+        self.dataset = dataset
+        self.region = region
+        self.chrom = region[0]
+        self.name = '{}:{}-{}'.format(region[0], region[1], region[2])
+        self.rows = collections.defaultdict(list)
+
+    def emitter(self, table, key = None):
+        append = self.rows[table].append
+        extra = [key, self.name] if key is not None else [self.name]
+        return lambda values: append(values + extra)
+
+    def stats(self, samples, summaries, counts):
+        for sample, summary in zip(samples, summaries):
+            if summary:
+                for measure in MEASURES:
+                    self.rows['summary_stat'].append([self.chrom, self.name, sample, measure, summary[measure]])
+                for n in range(0, 11, 1):
+                    self.rows['histogram'].append([self.chrom, self.name, sample, n / 10, counts[sample][n]])
+
+    def commit(self, done):
+        self.dataset.add(self.region, self.rows, done)
+
+    def discard(self):
+        self.rows = None
+
+class DatasetWriter:
+    '''
+    Consolidated output: one dataset per table under <output>/<table>/, split
+    in a directory per chromosome. Committed regions are buffered and written
+    together as new part files (bgzipped TSV or Parquet) every flush_rows rows;
+    a region is only reported done once its rows are on disk. The parts and
+    regions of a flush are listed in a manifest until all of them are renamed
+    and reported, so that an interrupted flush can be undone (see recover).
+    '''
+
+    def __init__(self, output, output_format, flush_rows):
+        self.output = output
+        self.format = output_format
+        self.flush_rows = flush_rows
+        self.rows = collections.defaultdict(list)
+        self.buffered = 0
+        self.pending = []
+        self.parts = 0
+        # Unique across the processes and nodes of a sharded run, whose parts are merged into one directory
+        self.stamp = '{}-{}-{}-{:08x}'.format(time.strftime('%Y%m%d%H%M%S'), socket.gethostname().split('.')[0], os.getpid(), random.getrandbits(32))
+        self.lock = threading.Lock()
+        self.manifest = os.path.join(output, 'dataset_flush.json')
+
+    def region(self, region):
+        return DatasetRegion(self, region)
+
+    def files(self, pattern):
+        return [path for table in DATASET_TABLES for path in glob.glob(os.path.join(self.output, table, '*', pattern))]
+
+    def clear(self):
+        for path in self.files('part-*'):
+            os.remove(path)
+        if os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+    def recover(self):
+        '''
+        Removes the parts of a flush interrupted before all its regions were
+        reported done, and returns those regions.
+        '''
+        if not os.path.exists(self.manifest):
+            return []
+        with open(self.manifest, 'rt') as handle:
+            flush = json.load(handle)
+        for path in flush['parts']:
+            path = os.path.join(self.output, path)
+            if os.path.exists(path):
+                os.remove(path)
+        os.remove(self.manifest)
+        return [tuple(region) for region in flush['regions']]
+
+    def add(self, region, rows, done):
+        with self.lock:
+            for table, table_rows in rows.items():
+                self.rows[(table, region[0])].extend(table_rows)
+                self.buffered += len(table_rows)
+            self.pending.append((region, done))
+            if self.buffered >= self.flush_rows:
+                self.flush()
+
+    def flush(self):
+        paths = []
+        for (table, chrom), rows in self.rows.items():
+            directory = os.path.join(self.output, table, chrom)
+            os.makedirs(directory, exist_ok = True)
+            path = os.path.join(directory, 'part-{}-{:05d}.{}'.format(self.stamp, self.parts, 'tsv.gz' if self.format == 'tsv.gz' else 'parquet'))
+            if table in ('meth', 'diffmeth', 'segments'):
+                rows.sort(key = lambda row: row[1])
+            if self.format == 'tsv.gz':
+                write_bgzf(path + '.part', table, rows)
+            else:
+                write_parquet(path + '.part', table, rows)
+            paths.append(path)
+        self.parts += 1
+        with open(self.manifest + '.part', 'wt') as handle:
+            json.dump({'parts': [os.path.relpath(path, self.output) for path in paths], 'regions': [region for region, done in self.pending]}, handle)
+        os.replace(self.manifest + '.part', self.manifest)
+        for path in paths:
+            os.replace(path + '.part', path)
+        for region, done in self.pending:
+            done()
+        os.remove(self.manifest)
+        self.rows = collections.defaultdict(list)
+        self.buffered = 0
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            if self.pending:
+                self.flush()
+
+def bgzf_blocks(data):
+    for start in range(0, len(data), 65280):
+        block = data[start:start + 65280]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(block) + compressor.flush()
+        yield struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+        yield compressed
+        yield struct.pack('<II', zlib.crc32(block) & 0xffffffff, len(block))
+    yield BGZF_EOF
+
+def write_bgzf(path, table, rows):
+    # Rows are sorted by position, so every part can be indexed with tabix -s 1 -b 2 -e 2
+    # (-e 3 for segments, whose end is their third column)
+    lines = ['#' + '\t'.join(name for name, kind in DATASET_TABLES[table])]
+    lines += ['\t'.join('.' if value is None else str(value) for value in row) for row in rows]
+    with open(path, 'wb') as handle:
+        handle.writelines(bgzf_blocks(('\n'.join(lines) + '\n').encode()))
+
+def write_parquet(path, table, rows):
+    import pyarrow, pyarrow.parquet
+    types = {'str': pyarrow.string(), 'int': pyarrow.int64(), 'float': pyarrow.float64()}
+    columns = list(zip(*rows))
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in DATASET_TABLES[table]])
+    data = pyarrow.Table.from_arrays([pyarrow.array(column, type = field.type) for column, field in zip(columns, schema)], schema = schema)
+    pyarrow.parquet.write_table(data, path)
+
+def discard_stale_parts(region, output):
+    name = '_'.join(region)
+    for pattern in [('*', name, '*.part'), ('segments', name + '.tsv.part'), ('segments', 'p*', name + '.tsv.part')]:
+        for path in glob.glob(os.path.join(output, *pattern)):
+            os.remove(path)
+
+def read_journal(output):
+    '''
+    Completed regions of a previous run, with the histograms each one added
+    to the run statistics. A line cut short by a crash is ignored.
+    '''
+    completed = {}
+    journal = os.path.join(output, 'completed_regions.bed')
+    if os.path.exists(journal):
+        with open(journal, 'rt') as handle:
+            for line in handle:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 4:
+                    continue
+                try:
+                    completed[(fields[0], str(int(fields[1]) + 1), fields[2])] = json.loads(fields[3])
+                except ValueError:
+                    continue
+    return completed
+
+def write_journal(path, completed):
+    with open(path + '.part', 'wt') as handle:
+        for region, histograms in completed.items():
+            handle.write('\t'.join([region[0], str(int(region[1]) - 1), region[2], json.dumps(histograms, separators = (',', ':'))]) + '\n')
+    os.replace(path + '.part', path)
+
+def plan_queries(regions, span, gap):
+    batches = []
+    for region in sorted(set(regions), key = region_key):
+        if batches:
+            query, members = batches[-1]
+            end = max(int(query[2]), int(region[2]))
+            if query[0] == region[0] and int(region[1]) - int(query[2]) - 1 <= gap and end - int(query[1]) + 1 <= span:
+                members.append(region)
+                batches[-1] = ((query[0], query[1], str(end)), members)
+                continue
+        batches.append((region, [region]))
+    return batches
+
+def shard_regions(regions, shard, shards, merge_span = 0, merge_gap = 1000):
+    '''
+    The regions of shard (1 to shards), in input order. Queries (regions, or
+    merged queries with merge_span) are assigned greedily, longest first, to
+    the shard with the fewest bp so far, so shards get similar amounts of
+    genome whatever the length of their regions. The assignment only depends
+    on the regions and the merge options: every node computes the same one,
+    resumed runs included.
+    '''
+    if merge_span:
+        batches = plan_queries(regions, merge_span, merge_gap)
+    else:
+        batches = [(region, [region]) for region in sorted(set(regions), key = region_key)]
+    batches.sort(key = lambda batch: (int(batch[0][1]) - int(batch[0][2]), region_key(batch[0])))
+    loads = [(0, n) for n in range(shards)]
+    mine = set()
+    for query, members in batches:
+        load, n = heapq.heappop(loads)
+        if n == shard - 1:
+            mine.update(members)
+        heapq.heappush(loads, (load + int(query[2]) - int(query[1]) + 1, n))
+    return [region for region in regions if region in mine]
+
+def split_records(query, regions, records, bounds):
+    if len(regions) == 1 and regions[0] == query:
+        yield regions[0], records
+        return
+    # Interval index: records sorted by start, searched back as far as the longest record reaches
+    records = sorted(records, key = lambda d: bounds(d)[0])
+    starts = [bounds(d)[0] for d in records]
+    longest = max([bounds(d)[1] - bounds(d)[0] for d in records] or [0])
+    for region in regions:
+        start, end = int(region[1]), int(region[2])
+        lo = bisect.bisect_left(starts, start - longest)
+        hi = bisect.bisect_right(starts, end)
+        yield region, [d for d in records[lo:hi] if bounds(d)[1] >= start]
+
+def merge_runs(shards, output, regions = None, link = False):
+    '''
+    Combines the output directories of several runs over disjoint regions
+    (e.g. the shards of a BED file) into output: region files and dataset
+    parts are copied (or hard linked), and the journals, failure manifests,
+    run statistics and metrics are merged. A file present in several shards
+    must be identical. With regions, those neither completed nor failed in
+    any shard are reported as missing.
+    '''
+    if os.path.realpath(output) in [os.path.realpath(shard) for shard in shards]:
+        raise ValueError('the merged output cannot be one of the shards')
+    make_outdir(output)
+    files = 0
+    completed = {}
+    failures = collections.OrderedDict()
+    samples = None
+    metrics = RunMetrics(os.path.join(output, 'stats'))
+    counters = collections.Counter()
+    elapsed = 0
+    for shard in shards:
+        if not os.path.isdir(shard):
+            raise ValueError('{} is not a directory'.format(shard))
+        for root, dirs, names in os.walk(shard):
+            directory = os.path.relpath(root, shard)
+            dirs.sort()
+            # Journals, logs and run-level statistics are merged below
+            if directory in ('.', 'stats'):
+                continue
+            for name in sorted(names):
+                if name.endswith('.part'):
+                    logger.warning('Skipping unfinished file {}'.format(os.path.join(root, name)))
+                    continue
+                source = os.path.join(root, name)
+                target = os.path.join(output, directory, name)
+                if os.path.exists(target):
+                    if not filecmp.cmp(source, target, shallow = False):
+                        raise ValueError('{} differs from a file of another shard'.format(source))
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok = True)
+                if link:
+                    os.link(source, target)
+                else:
+                    shutil.copy2(source, target)
+                files += 1
+        for region, histograms in read_journal(shard).items():
+            completed.setdefault(region, histograms)
+        if os.path.exists(os.path.join(shard, 'failed_regions.bed')):
+            with open(os.path.join(shard, 'failed_regions.bed'), 'rt') as handle:
+                for line in handle:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) >= 3:
+                        failures.setdefault((fields[0], str(int(fields[1]) + 1), fields[2]), line)
+        stats = os.path.join(shard, 'stats')
+        if os.path.exists(os.path.join(stats, 'run_summary_stat.tsv')):
+            with open(os.path.join(stats, 'run_summary_stat.tsv'), 'rt') as handle:
+                header = handle.readline().rstrip('\n').split('\t')[2:]
+            if samples is not None and header != samples:
+                raise ValueError('{} has other samples ({}) than the previous shards ({})'.format(shard, ', '.join(header), ', '.join(samples)))
+            samples = header
+        if os.path.exists(os.path.join(stats, 'region_metrics.tsv')):
+            metrics.load(os.path.join(stats, 'region_metrics.tsv'))
+        if os.path.exists(os.path.join(stats, 'run_metrics.json')):
+            with open(os.path.join(stats, 'run_metrics.json'), 'rt') as handle:
+                summary = json.load(handle)
+            counters.update(summary['client'])
+            elapsed = max(elapsed, summary['elapsed'])
+    write_journal(os.path.join(output, 'completed_regions.bed'), completed)
+    failed = [region for region in failures if region not in completed]
+    if failed:
+        with open(os.path.join(output, 'failed_regions.bed'), 'wt') as handle:
+            handle.writelines(failures[region] for region in failed)
+    elif os.path.exists(os.path.join(output, 'failed_regions.bed')):
+        os.remove(os.path.join(output, 'failed_regions.bed'))
+    stats = RunStats()
+    for histograms in completed.values():
+        stats.add(histograms)
+    if samples is None:
+        samples = sorted(set(sample for histograms in stats.histograms.values() for sample in histograms))
+    stats.save(os.path.join(output, 'stats', 'run_stats.json'))
+    stats.write(os.path.join(output, 'stats'), samples)
+    summary = metrics.close(dict(counters), elapsed)
+    missing = None
+    if regions is not None:
+        missing = [region for region in collections.OrderedDict.fromkeys(regions) if region not in completed and region not in failures]
+    return {'shards': len(shards), 'files': files, 'completed': len(completed), 'failed': len(failed), 'missing': missing, 'metrics': summary}
+
+class RegionRun:
+    '''
+    Downloads regions of an assembly into an output directory, either as files
+    per region (output_format 'tsv') or as a consolidated dataset. Keeps the
+    journal of completed regions (resume skips them), the manifest of failed
+    ones and the run-level statistics, which close() writes to stats/ with
+    the timings of every query (see RunMetrics). The methylation and
+    segments queries of a region run concurrently, and those of the next
+    regions start while a region is being written. With a profiler, the
+    work of every thread is profiled.
+    '''
+
+    def __init__(self, client, assembly, samples, output, percentiles = ('95',), output_format = 'tsv', flush_rows = 1000000, resume = False,
+                 meth = True, segments = True, profiler = None):
+        if not meth and not segments:
+            raise ValueError('nothing to download: both meth and segments are disabled')
+        self.client = client
+        self.assembly = assembly
+        self.samples = [str(sample) for sample in samples]
+        self.output = output
+        self.percentiles = [str(percentile) for percentile in percentiles]
+        self.layout = TSV_TABLES_PERCENTILES if len(self.percentiles) > 1 else TSV_TABLES
+        self.transformer = MethTransformer(self.samples)
+        self.meth = meth
+        self.segments = segments
+        self.pool = None
+        self.profiler = profiler
+        self.stats = RunStats()
+        self.metrics = RunMetrics(os.path.join(output, 'stats'))
+        self.journal = os.path.join(output, 'completed_regions.bed')
+        self.journal_lock = threading.Lock()
+        self.failures = os.path.join(output, 'failed_regions.bed')
+        self.failures_lock = threading.Lock()
+        self.stopping = threading.Event()
+        make_outdir(output)
+        self.dataset = None
+        if output_format != 'tsv':
+            self.dataset = DatasetWriter(output, output_format, flush_rows)
+            for path in self.dataset.files('*.part'):
+                os.remove(path)
+            if not resume:
+                self.dataset.clear()
+        self.completed = {}
+        if resume:
+            self.completed = read_journal(output)
+            interrupted = self.dataset.recover() if self.dataset else []
+            if interrupted:
+                # Their rows were removed with the parts of the interrupted flush
+                logger.warning('Fetching again {} region(s) of an interrupted dataset flush'.format(len(interrupted)))
+                for region in interrupted:
+                    self.completed.pop(region, None)
+                write_journal(self.journal, self.completed)
+            for histograms in self.completed.values():
+                self.stats.add(histograms)
+        elif os.path.exists(self.journal):
+            os.remove(self.journal)
+        if os.path.exists(self.failures):
+            os.remove(self.failures)
+
+    def plan(self, regions, merge_span = 0, merge_gap = 1000):
+        '''
+        Batches (query, regions) of the regions not completed yet. With
+        merge_span, nearby regions share a query (a list is returned).
+        '''
+        regions = ((region[0], str(region[1]), str(region[2])) for region in regions)
+        regions = (region for region in regions if region not in self.completed)
+        if merge_span:
+            return plan_queries(regions, merge_span, merge_gap)
+        return ((region, [region]) for region in regions)
+
+    def run(self, batches, jobs = 1):
+        '''
+        Fetches the batches with up to jobs threads, yielding every batch with
+        its number of failed regions as it finishes.
+        '''
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 4 * jobs) as self.pool:
+            started = lookahead(map(self.start, batches), jobs)
+            for (batch, meth, segments, counters), errors in run_regions(started, jobs, self.profiled(self.fetch_batch), self.stopping):
+                yield batch, errors
+
+    def profiled(self, function):
+        return self.profiler.wrap(function) if self.profiler else function
+
+    def stop(self):
+        '''
+        Lets the regions in progress finish and starts no more (thread safe,
+        e.g. from a signal handler). The journal allows resuming the rest.
+        '''
+        self.stopping.set()
+
+    def close(self):
+        '''
+        Writes the remaining output and the run statistics and metrics.
+        Returns the summary of the metrics (see RunMetrics).
+        '''
+        if self.dataset:
+            self.dataset.close()
+        self.stats.save(os.path.join(self.output, 'stats', 'run_stats.json'))
+        self.stats.write(os.path.join(self.output, 'stats'), self.samples)
+        self.client.cache_evict()
+        return self.metrics.close(self.client.counters.snapshot())
+
+    def start(self, batch):
+        '''
+        Issues the queries of a batch in the request pool without waiting for
+        them. Streamed methylation data is only requested when it is written.
+        '''
+        query = batch[0]
+        meth = None
+        segments = []
+        counters = Counters()
+        fetch = self.profiled(lambda function, *args: list(function(*args, counters = counters)))
+        if self.meth and not self.client.stream:
+            meth = self.pool.submit(self.profiled(self.fetch_meth), query, len(batch[1]) > 1, counters)
+        if self.segments:
+            for percentile in self.percentiles:
+                segments.append((percentile, self.pool.submit(fetch, self.client.segments, self.assembly, query, percentile)))
+        return batch, meth, segments, counters
+
+    def fetch_meth(self, query, merged, counters):
+        '''
+        MethColumns of a query, built as soon as its response arrives so
+        that only the compact columns wait for the writer. Merged queries
+        are sorted by position to be sliced into their regions.
+        '''
+        records = self.client.region(self.assembly, query, self.samples, counters = counters)
+        started = time.perf_counter()
+        if merged:
+            records = sorted(records, key = lambda d: d['pos'])
+        data = self.transformer.columns(records)
+        counters.add('parse', time.perf_counter() - started)
+        return data
+
+    def fetch_batch(self, started):
+        (query, regions), meth, segments, counters = started
+        writers = collections.OrderedDict()
+        for region in regions:
+            if self.dataset:
+                writers[region] = self.dataset.region(region)
+            else:
+                writers[region] = RegionWriter(self.output, region, self.layout)
+                discard_stale_parts(region, self.output)
+        try:
+            histograms = self.get_region(query, regions, writers, meth, segments, counters)
+        except BaseException as error:
+            for writer in writers.values():
+                writer.discard()
+            if not isinstance(error, APIError):
+                raise
+            for region in regions:
+                logger.error('Region {}:{}-{} failed: {}'.format(region[0], region[1], region[2], error))
+                self.record_failure(region, error)
+            self.record_metrics(query, regions, True, counters)
+            return len(regions)
+        # Rows are written and statistics computed while they are built
+        written = sum(writer.seconds for writer in writers.values())
+        counters.add('transform', -written - counters.snapshot().get('stats', 0))
+        committed = time.perf_counter()
+        for region, writer in writers.items():
+            self.stats.add(histograms.get(region, {}))
+            writer.commit(functools.partial(self.record_completed, region, histograms.get(region, {})))
+        counters.add('write', written + time.perf_counter() - committed)
+        self.record_metrics(query, regions, False, counters)
+        return 0
+
+    def get_region(self, query, regions, writers, meth, segments, counters):
+        '''
+        Writes the data of a batch, adding the time spent waiting for its
+        responses and building its rows and statistics to counters.
+        '''
+        logger.info('Getting data from region {}:{}-{}'.format(query[0], query[1], query[2]))
+        histograms = {}
+        if self.meth:
+            if meth is not None:
+                waited = time.perf_counter()
+                data = meth.result()
+                counters.add('wait', time.perf_counter() - waited)
+                streamed = None
+            else:
+                streamed = Counters()
+                data = self.client.region(self.assembly, query, self.samples, counters = streamed)
+            processed = time.perf_counter()
+            if streamed is None:
+                parts = data.split(query, regions)
+            else:
+                parts = split_records(query, regions, data, lambda d: (d['pos'], d['pos']))
+            for region, records in parts:
+                if streamed is not None:
+                    records = iter(records)
+                    first = next(records, None)
+                    records = itertools.chain([first], records) if first is not None else None
+                if not records:
+                    logger.warning('No data available in region {}:{}-{}!'.format(region[0], region[1], region[2]))
+                    continue
+                histograms[region] = self.transformer.write(region, records, writers[region], counters)
+            counters.add('transform', time.perf_counter() - processed)
+            if streamed is not None:
+                # The streamed response was read and parsed while the rows were built
+                values = streamed.snapshot()
+                counters.add('transform', -values.get('throttle', 0) - values.get('request', 0) - values.get('parse', 0))
+                counters.merge(streamed)
+        # Methylation segments analysis, independent of the methylation data of the regions
+        for percentile, future in segments:
+            waited = time.perf_counter()
+            data = future.result()
+            processed = time.perf_counter()
+            counters.add('wait', processed - waited)
+            for region, records in split_records(query, regions, data, lambda d: (d['start'], d['end'])):
+                records = iter(records)
+                first = next(records, None)
+                if first is None:
+                    logger.warning('No data available in region {}:{}-{} (percentile {})!'.format(region[0], region[1], region[2], percentile))
+                    continue
+                write_segments(region, itertools.chain([first], records), self.samples, self.output, writers[region], percentile)
+            counters.add('transform', time.perf_counter() - processed)
+        # /Methylation segments analysis
+        return histograms
+
+    def record_metrics(self, query, regions, failed, counters):
+        values = counters.snapshot()
+        values['seconds'] = time.perf_counter() - counters.created
+        self.metrics.add(query, regions, failed, values)
+
+    def record_failure(self, region, error):
+        with self.failures_lock:
+            with open(self.failures, 'at') as handle:
+                handle.write('\t'.join([region[0], str(int(region[1]) - 1), region[2], str(error)]) + '\n')
+
+    def record_completed(self, region, histograms):
+        with self.journal_lock:
+            with open(self.journal, 'at') as handle:
+                handle.write('\t'.join([region[0], str(int(region[1]) - 1), region[2], json.dumps(histograms, separators = (',', ':'))]) + '\n')
+                handle.flush()
+                os.fsync(handle.fileno())
+
+# Methylation contexts: name and keys of the methylation and differential methylation data in API records
+CONTEXTS = (('CG', 'meth_cg', 'diffmeth_cg'), ('CHG', 'meth_chg', 'diffmeth_chg'), ('CHH', 'meth_chh', 'diffmeth_chh'))
+
+# Values of a row of a sample in MethColumns: codes of the context (in
+# CONTEXTS) and genotype, and strand counts (-1: missing)
+SAMPLE_VALUES = ('context', 'genotype', 'w_methylatedReads', 'w_coverage', 'w_phredScore', 'c_methylatedReads', 'c_coverage', 'c_phredScore')
+# Values of a differential methylation row: codes of the context, sample pair
+# and method, and whether all three methods are significant
+DIFFMETH_VALUES = ('context', 'pair', 'method', 'consensus')
+
+class MethColumns:
+    '''
+    Methylation records of a query in typed arrays, 4 bytes per value instead
+    of nested dicts: for every sample, the position of every row (one per
+    position and context with data) and its SAMPLE_VALUES, one row after the
+    other in a single array, and likewise for the differential methylation
+    rows (DIFFMETH_VALUES), with their p-values apart (those that are not
+    floats, by row, in pvalues_other). Rows are kept in record order; records
+    must come sorted by position to be sliced into regions.
+    '''
+    __slots__ = ('chrom', 'positions', 'samples', 'genotypes', 'methods', 'diffmeth_pos', 'diffmeth', 'pvalues', 'pvalues_other')
+
+    def __init__(self, chrom, samples, genotypes, methods):
+        self.chrom = chrom
+        self.positions = array.array('i')
+        self.samples = collections.OrderedDict((sample, (array.array('i'), array.array('i'))) for sample in samples)
+        self.genotypes = genotypes
+        self.methods = methods
+        self.diffmeth_pos = array.array('i')
+        self.diffmeth = array.array('i')
+        self.pvalues = array.array('d')
+        self.pvalues_other = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def rows(self):
+        '''
+        Yields the meth rows, sample after sample, as MethTransformer.rows
+        does.
+        '''
+        genotypes = self.genotypes
+        for sample, (positions, values) in self.samples.items():
+            values = iter(values)
+            for pos, code, genotype, w_methylatedReads, w_coverage, w_phredScore, c_methylatedReads, c_coverage, c_phredScore in zip(positions, *[values] * len(SAMPLE_VALUES)):
+                yield (sample, pos, code, genotypes[genotype],
+                       w_methylatedReads if w_methylatedReads >= 0 else None, w_coverage if w_coverage >= 0 else None, w_phredScore if w_phredScore >= 0 else None,
+                       c_methylatedReads if c_methylatedReads >= 0 else None, c_coverage if c_coverage >= 0 else None, c_phredScore if c_phredScore >= 0 else None)
+
+    def pair_rows(self):
+        '''
+        Yields the differential methylation rows, as passed to the pair
+        function of MethTransformer.rows.
+        '''
+        pvalues = self.pvalues
+        if self.pvalues_other:
+            pvalues = [self.pvalues_other.get(n, pvalue) for n, pvalue in enumerate(pvalues)]
+        methods = self.methods
+        values = iter(self.diffmeth)
+        for pos, code, pair, method, consensus, pvalue in zip(self.diffmeth_pos, values, values, values, values, pvalues):
+            yield pos, code, pair, methods[method], pvalue, consensus
+
+    def slice(self, start, end):
+        '''
+        The rows of the positions in [start, end].
+        '''
+        part = MethColumns(self.chrom, (), self.genotypes, self.methods)
+        part.positions = self.positions[bisect.bisect_left(self.positions, start):bisect.bisect_right(self.positions, end)]
+        stride = len(SAMPLE_VALUES)
+        for sample, (positions, values) in self.samples.items():
+            lo, hi = bisect.bisect_left(positions, start), bisect.bisect_right(positions, end)
+            part.samples[sample] = (positions[lo:hi], values[lo * stride:hi * stride])
+        lo, hi = bisect.bisect_left(self.diffmeth_pos, start), bisect.bisect_right(self.diffmeth_pos, end)
+        part.diffmeth_pos = self.diffmeth_pos[lo:hi]
+        part.diffmeth = self.diffmeth[lo * len(DIFFMETH_VALUES):hi * len(DIFFMETH_VALUES)]
+        part.pvalues = self.pvalues[lo:hi]
+        part.pvalues_other = dict((n - lo, pvalue) for n, pvalue in self.pvalues_other.items() if lo <= n < hi)
+        return part
+
+    def split(self, query, regions):
+        '''
+        Yields every region with its columns.
+        '''
+        if len(regions) == 1 and regions[0] == query:
+            yield regions[0], self
+            return
+        for region in regions:
+            yield region, self.slice(int(region[1]), int(region[2]))
+
+class MethTransformer:
+    '''
+    Turns API position records into meth and diffmeth rows for every context
+    (CG, CHG, CHH), either straight from the records (streamed responses) or
+    through MethColumns. Sample and pair keys are split and joined once, when
+    the transformer is created, instead of for every position.
+    '''
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.keys = [(sample,) + tuple(sample.split('.')) for sample in samples]
+        self.pairs = []
+        for sample1, sample2 in itertools.combinations(samples, 2):
+            individual1, s1 = sample1.split('.')
+            individual2, s2 = sample2.split('.')
+            kind = 'intraindividual' if individual1 == individual2 else 'interindividual'
+            self.pairs.append((sample1, sample2, individual1 + '#' + individual2, s1 + '#' + s2, kind))
+
+    def rows(self, records, pair):
+        '''
+        Yields the meth rows of API position records: sample, position,
+        context code (in CONTEXTS), genotype and strand counts (None: missing).
+        Differential methylation rows are passed to pair instead: position,
+        context code, index of the sample pair, method, p-value and whether
+        all three methods are significant.
+        '''
+        contexts = [(code, meth, diffmeth) for code, (context, meth, diffmeth) in enumerate(CONTEXTS)]
+        for d in records:
+            pos, genotype = d['pos'], d['genotype']
+            found = []
+            for code, meth, diffmeth in contexts:
+                if meth in d:
+                    m = d[meth]
+                    w, c = m['w'], m['c']
+                    found.append((code, m, w['methylatedReads'], w['coverage'], w['phredScore'], c['methylatedReads'], c['coverage'], c['phredScore']))
+            for sample, individual, s in self.keys:
+                for code, m, wm, wc, wp, cm, cc, cp in found:
+                    if individual not in m or s not in m[individual]:
+                        continue
+                    yield sample, pos, code, genotype[individual][s], wm[individual][s], wc[individual][s], wp[individual][s], cm[individual][s], cc[individual][s], cp[individual][s]
+            if not self.pairs:
+                continue
+            for code, meth, diffmeth in contexts:
+                if diffmeth not in d:
+                    continue
+                dm = d[diffmeth]
+                for index, (sample1, sample2, individual_pair, sample_pair, kind) in enumerate(self.pairs):
+                    if individual_pair in dm and sample_pair in dm[individual_pair]:
+                        pvalues = dm[individual_pair][sample_pair]
+                        consensus = len(pvalues) == 3
+                        for method, pvalue in pvalues.items():
+                            pair(pos, code, index, method, pvalue, consensus)
+
+    def columns(self, records):
+        '''
+        MethColumns of API position records.
+        '''
+        records = iter(records)
+        first = next(records, None)
+        data = MethColumns(first['chrom'] if first is not None else None, self.samples, [], [])
+        if first is None:
+            return data
+        genotypes, methods = {}, {}
+        columns = dict((sample, (positions.append, values.extend, values)) for sample, (positions, values) in data.samples.items())
+        add_record = data.positions.append
+        def add_pair(pos, code, pair, method, pvalue, consensus):
+            if method not in methods:
+                methods[method] = len(data.methods)
+                data.methods.append(method)
+            if type(pvalue) is not float:
+                data.pvalues_other[len(data.pvalues)] = pvalue
+                pvalue = 0.0
+            data.diffmeth_pos.append(pos)
+            data.diffmeth.extend((code, pair, methods[method], 1 if consensus else 0))
+            data.pvalues.append(pvalue)
+        def positions(records):
+            for d in records:
+                add_record(d['pos'])
+                yield d
+        for sample, pos, code, genotype, *counts in self.rows(positions(itertools.chain([first], records)), add_pair):
+            append, extend, values = columns[sample]
+            if genotype not in genotypes:
+                genotypes[genotype] = len(data.genotypes)
+                data.genotypes.append(genotype)
+            try:
+                extend((code, genotypes[genotype]))
+                extend(counts)
+            except TypeError:
+                # A missing (null) count: undo the values appended before it
+                del values[len(values) - len(values) % len(SAMPLE_VALUES):]
+                extend([code, genotypes[genotype]] + [-1 if count is None else count for count in counts])
+            append(pos)
+        return data
+
+    def write(self, region, data, writer, counters = None):
+        '''
+        Writes the rows and statistics of a region, from MethColumns or from
+        an iterable of API position records. Returns its methylation ratio
+        histograms by context and sample (only those with data). The time
+        spent on the statistics is added to counters as 'stats'.
+        '''
+        histogram = collections.OrderedDict((context, collections.OrderedDict((sample, [0] * 11) for sample in self.samples)) for context, meth, diffmeth in CONTEXTS)
+        emit = dict((sample, writer.emitter('meth', sample)) for sample in self.samples)
+        emit_pair = {}
+        names = [context for context, meth, diffmeth in CONTEXTS]
+        logger.info('Calculating...')
+        if isinstance(data, MethColumns):
+            chrom = data.chrom
+        else:
+            data = iter(data)
+            first = next(data, None)
+            chrom = first['chrom'] if first is not None else None
+            data = itertools.chain([first], data) if first is not None else ()
+        def pair(pos, code, index, method, pvalue, consensus):
+            sample1, sample2, individual_pair, sample_pair, kind = self.pairs[index]
+            if kind not in emit_pair:
+                emit_pair[kind] = writer.emitter('diffmeth', kind)
+            emit_pair[kind]([chrom, pos, names[code], sample1, sample2, method, pvalue, 'True' if consensus else 'False'])
+        if isinstance(data, MethColumns):
+            self.emit(chrom, data.rows(), histogram, emit)
+            for row in data.pair_rows():
+                pair(*row)
+        else:
+            self.emit(chrom, self.rows(data, pair), histogram, emit)
+        started = time.perf_counter()
+        counts = collections.OrderedDict((sample, [sum(column) for column in zip(*(histogram[context][sample] for context in histogram))]) for sample in self.samples)
+        writer.stats(self.samples, [summarize(counts[sample]) for sample in self.samples], counts)
+        if counters is not None:
+            counters.add('stats', time.perf_counter() - started)
+        logger.info('Done')
+        return dict((context, dict((sample, counts) for sample, counts in histogram[context].items() if any(counts))) for context in histogram if any(map(any, histogram[context].values())))
+
+    def emit(self, chrom, rows, histogram, emit):
+        '''
+        Writes meth rows (see rows), adding their methylation ratios to the
+        histograms.
+        '''
+        names = [context for context, meth, diffmeth in CONTEXTS]
+        counts = dict((sample, [histogram[context][sample] for context in names]) for sample in self.samples)
+        for sample, pos, code, genotype, w_methylatedReads, w_coverage, w_phredScore, c_methylatedReads, c_coverage, c_phredScore in rows:
+            w_methRatio = round(w_methylatedReads / w_coverage, 2) if w_methylatedReads and w_coverage else None
+            c_methRatio = round(c_methylatedReads / c_coverage, 2) if c_methylatedReads and c_coverage else None
+            methylatedReads = (w_methylatedReads or 0) + (c_methylatedReads or 0)
+            coverage = (w_coverage or 0) + (c_coverage or 0)
+            if not w_phredScore:
+                phredScore = c_phredScore
+            elif not c_phredScore:
+                phredScore = w_phredScore
+            else:
+                phredScore = int((w_phredScore + c_phredScore) / 2)
+            methRatio = None
+            if coverage:
+                methRatio = round(methylatedReads / coverage, 2)
+                counts[sample][code][round(round(methRatio, 1) * 10)] += 1
+            emit[sample]([chrom, pos, genotype, names[code], w_methylatedReads, w_coverage, w_phredScore, c_methylatedReads, c_coverage, c_phredScore,
+                          methylatedReads, coverage, phredScore, w_methRatio, c_methRatio, methRatio])
+
+def write_segments(region, data, samples, output, writer, percentile):
+    logger.info('Calculating...')
+    keys = [(s,) + tuple(s.split('.')) for s in samples]
+    emit = None
+    for d in data:
+        for s, individual, sample in keys:
+            if individual in d['samples']:
+                if sample in d['samples'][individual]:
+                    if emit is None:
+                        emit = writer.emitter('segments', percentile)
+                    emit([d['chrom'], d['start'], d['end'], 'CG', d['samples']['sampleCount'], s, d['samples'][individual][sample]['methRatio']])
+    logger.info('Done')
+
 def signal_handler(signal, frame):
         res = input('Do you want to cancel? [Y/N]: ')
         if res.upper() == 'Y':
             raise SystemExit
 
-def percentile(N, percent, key=lambda x:x):
-    if not N:
-        return None
-    k = (len(N)-1) * percent
-    f = math.floor(k)
-    c = math.ceil(k)
-    if f == c:
-        return key(N[int(k)])
-    d0 = key(N[int(f)]) * (c-k)
-    d1 = key(N[int(c)]) * (k-f)
-    return d0+d1
+def exit_signal_handler(signum, frame):
+    logger.critical('Interrupted. Leaving the program...')
+    raise SystemExit(128 + signum)
+
+def batch_signal_handler(run, signum, frame):
+    if run.stopping.is_set():
+        logger.critical('Interrupted again. Leaving the program...')
+        raise SystemExit(128 + signum)
+    logger.critical('Interrupted. Finishing the regions in progress (signal again to leave now)...')
+    run.stop()
 
 def welcome(display):
     text = '''
@@ -43,29 +1928,17 @@ def welcome(display):
         d.set_background_title("NSGmethDB API Client")
         d.msgbox(text.replace('<b>','\Zb').replace('</b>','\ZB'), title = title, colors = True)
 
-def get_assembly(server):
-    url = os.path.join(server, 'info')
-    n = 0
-    while True:
-        try:
-            res = requests.get(url)
-            break
-        except:
-            n += 1
-            if n < retries:
-                logger.warning('Internet connection failed. Retrying...')
-            else:
-                logger.critical('Unable to connect to the Internet! Leaving the program...')
-                raise SystemExit
-    if res.status_code != 200:
-        logger.error('API Error: ' + str(res.status_code))
+def get_assembly(client):
+    try:
+        data = client.assemblies()
+    except APIError as error:
+        logger.error(str(error))
         logger.critical('Unable to reach the NGSmethDB API Server! Leaving the program...')
         raise SystemExit
-    data = res.json()
     text = "Select an assembly from the list below."
     if display:
         names = ['Select', 'Assembly', 'Common', 'Species']
-        choices = [('', a['assembly'], a['common'], a['species']) for a in data]
+        choices = [('', a.assembly, a.common, a.species) for a in data]
         assembly = PyZenity.List(names, title = title, text = text, boolstyle = "radiolist", data = choices)[0]
         if not assembly:
             logger.critical('Assembly not selected. Leaving the program...')
@@ -74,7 +1947,7 @@ def get_assembly(server):
     else:
         d = dialog.Dialog(dialog = 'dialog' if not OS.startswith('win') else os.path.join(os.path.dirname(os.path.realpath(__file__)), 'windows', 'dialog.exe'), autowidgetsize = True)
         d.set_background_title("NSGmethDB API Client")
-        choices = [(a['assembly'], " ".join([a['common'], '(' + a['species'] + ')']), False) for a in data]
+        choices = [(a.assembly, " ".join([a.common, '(' + a.species + ')']), False) for a in data]
         code, assembly = d.radiolist(text, title = title, choices = choices)
         if code != d.OK or not assembly:
             logger.critical('Assembly not selected. Leaving the program...')
@@ -82,32 +1955,17 @@ def get_assembly(server):
         else:
             return assembly
 
-def get_samples(assembly, server):
-    url = os.path.join(server, assembly, 'samples')
-    n = 0
-    while True:
-        try:
-            res = requests.get(url)
-            break
-        except:
-            n += 1
-            if n < retries:
-                logger.warning('Internet connection failed. Retrying...')
-            else:
-                logger.critical('Unable to connect to the Internet! Leaving the program...')
-                raise SystemExit
-    if res.status_code != 200:
-        logger.error('API Error: ' + str(res.status_code))
+def get_samples(client, assembly):
+    try:
+        data = client.samples(assembly)
+    except APIError as error:
+        logger.error(str(error))
         logger.critical('Unable to reach the NGSmethDB API Server! Leaving the program...')
         raise SystemExit
-    data = res.json()
     text = "Select one or more samples from the list below."
     if display:
         names = ['Select', 'ID', 'Individual', 'Sample']
-        choices = []
-        for individual in sorted(data.keys()):
-            for sample in sorted(data[individual]):
-                choices.append(('', ".".join([individual, sample]), individual, sample))
+        choices = [('', str(s), s.individual, s.sample) for s in data]
         samples = PyZenity.List(names, title = title, text = text, boolstyle = "checklist", data = choices)
         if not samples[0]:
             logger.critical('Sample(s) not selected. Leaving the program...')
@@ -116,10 +1974,7 @@ def get_samples(assembly, server):
     else:
         d = dialog.Dialog(dialog = 'dialog' if not OS.startswith('win') else os.path.join(os.path.dirname(os.path.realpath(__file__)), 'windows', 'dialog.exe'), autowidgetsize = True)
         d.set_background_title("NSGmethDB API Client")
-        choices = []
-        for individual in sorted(data.keys()):
-            for sample in sorted(data[individual]):
-                choices.append((".".join([individual, sample]), " ".join([individual, sample]), False))
+        choices = [(str(s), " ".join(s), False) for s in data]
         code, samples = d.checklist(text, title = title, choices = choices)
         if code != d.OK or not samples:
             logger.critical('Sample(s) not selected. Leaving the program...')
@@ -127,6 +1982,23 @@ def get_samples(assembly, server):
         else:
             return samples
 
+def check_config(client, assembly, samples):
+    try:
+        unknown = client.unknown_samples(assembly, samples)
+    except ValueError as error:
+        logger.critical('{} in the configuration file! Leaving the program...'.format(error))
+        raise SystemExit(1)
+    except APIError as error:
+        if client.offline:
+            logger.warning('Unable to check the configuration file ({})'.format(error))
+            return
+        logger.error(str(error))
+        logger.critical('Unable to reach the NGSmethDB API Server! Leaving the program...')
+        raise SystemExit(1)
+    if unknown:
+        logger.critical('Unknown sample(s) for {} in the configuration file: {}. Leaving the program...'.format(assembly, ', '.join(unknown)))
+        raise SystemExit(1)
+
 def save_config(assembly, samples):
     text = "Where to save the configuration file?"
     if display:
@@ -142,32 +2014,6 @@ def save_config(assembly, samples):
             with open(config, 'wt') as handle:
                 json.dump({'assembly':assembly, 'samples':samples}, handle)
 
-def config_parser(configfile):
-    data = json.load(configfile)
-    return data['assembly'], data['samples']
-
-def make_outdir(output):
-    if not os.path.exists(output):
-        os.makedirs(output)
-
-def bed_reader(bedfile):
-    csv_reader = csv.reader(bedfile, delimiter='\t')
-    for row in csv_reader:
-        try:
-            region = row[0], str(int(row[1])+1), str(int(row[2]))
-        except:
-            logger.critical('INVALID BED FILE! Leaving the program...')
-            raise SystemExit
-        yield region
-
-def get_total(bedfile):
-    p = subprocess.Popen(['wc', '-l', bedfile.name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    result, err = p.communicate()
-    if p.returncode != 0:
-        logger.critical('INVALID BED FILE! Leaving the program...')
-        raise SystemExit
-    return int(result.strip().split()[0])
-
 def progress(bar, message, index, total):
     percentage = int((index / total) * 100)
     if display:
@@ -175,296 +2021,36 @@ def progress(bar, message, index, total):
     else:
         bar.gauge_update(text = message, percent = percentage, update_text = True)
 
-def get_region(index, total, region, assembly, samples, output, server, bar):
-    if index == 0 and not display:
-        bar.gauge_start()
-    logger.info('Getting data from region {}:{}-{}'.format(region[0], region[1], region[2]))
-    progress(bar, 'Getting data from region {}:{}-{}'.format(region[0], region[1], region[2]), index, total)
-    meth_ratio = collections.OrderedDict()
-    for n in range(0, 11, 1):
-        meth_ratio[n/10] = {}
-        for sample in samples:
-            meth_ratio[n/10][sample] = 0
-    for sample in samples:
-        meth_ratio[sample] = []
-    query = region[0] + ":" + region[1] + "-" + region[2] + '?samples=' + ",".join(samples)
-    url = os.path.join(server, assembly, query)
-    logger.info('Methylation Levels and DMCs - GET: ' + url)
-    n = 0
-    while True:
-        try:
-            res = requests.get(url)
-            break
-        except:
-            n += 1
-            if n < retries:
-                logger.warning('Internet connection failed. Retrying...')
-            else:
-                logger.critical('Unable to connect to the Internet! Leaving the program...')
-                raise SystemExit
-    if res.status_code != 200:
-        logger.error('API Error: ' + str(res.status_code))
-        logger.critical('Unable to reach the NGSmethDB API Server! Leaving the program...')
-        raise SystemExit
-    data = res.json()
-    if not data:
-        logger.warning('No data available in this region!')
-        progress(bar, region, index + 1, total)
-        return
-    logger.info('Calculating...')
-    meth_cg = os.path.join(output,'meth', "_".join(region))
-    stats = os.path.join(output, 'stats', "_".join(region))
-    if not os.path.exists(meth_cg): os.makedirs(meth_cg)
-    if not os.path.exists(stats): os.makedirs(stats)
-    for sample in samples:
-        with open(os.path.join(meth_cg, sample + '.tsv'), 'wt') as handle:
-            header = ['#chrom', 'pos', 'genotype', 'methContext', 'w_methylatedReads', 'w_coverage', 'w_phredScore', 'c_methylatedReads', 'c_coverage', 'c_phredScore']
-            header += ['methylatedReads', 'coverage', 'phredScore', 'w_methRatio', 'c_methRatio', 'methRatio']
-            header = '\t'.join(header) + '\n'
-            handle.write(header)
-    for d in data:
-        for sample in samples:
-            individual, s = sample.split('.')
-            if 'meth_cg' in d:
-                if individual in d['meth_cg']:
-                    if s in d['meth_cg'][individual]:
-                        line = [d['chrom'], d['pos'], d['genotype'][individual][s], 'CG']
-                        w_methylatedReads = d['meth_cg']['w']['methylatedReads'][individual][s]
-                        w_coverage = d['meth_cg']['w']['coverage'][individual][s]
-                        w_phredScore = d['meth_cg']['w']['phredScore'][individual][s]
-                        w_methRatio = round(w_methylatedReads/w_coverage, 2) if w_methylatedReads and w_coverage else None
-                        c_methylatedReads = d['meth_cg']['c']['methylatedReads'][individual][s]
-                        c_coverage = d['meth_cg']['c']['coverage'][individual][s]
-                        c_phredScore = d['meth_cg']['c']['phredScore'][individual][s]
-                        c_methRatio = round(c_methylatedReads/c_coverage, 2) if c_methylatedReads and c_coverage else None
-                        methylatedReads = sum(filter(None, [w_methylatedReads, c_methylatedReads]))
-                        coverage = sum(filter(None, [w_coverage, c_coverage]))
-                        if not w_phredScore:
-                            phredScore = c_phredScore
-                        elif not c_phredScore:
-                            phredScore = w_phredScore
-                        else:
-                            phredScore = int(sum([w_phredScore, c_phredScore])/2)
-                        methRatio = round(methylatedReads/coverage, 2)
-                        meth_ratio[round(methRatio, 1)][sample] += 1
-                        meth_ratio[sample].append(round(methRatio, 1))
-                        with open(os.path.join(meth_cg, sample + '.tsv'), 'at') as handle:
-                            line += [w_methylatedReads, w_coverage, w_phredScore, c_methylatedReads, c_coverage, c_phredScore, methylatedReads, coverage, phredScore, w_methRatio, c_methRatio, methRatio]
-                            line = [str(value) if value else '.' for value in line]
-                            line = '\t'.join(line) + '\n'
-                            handle.write(line)
-            if 'meth_chg' in d:
-                if individual in d['meth_chg']:
-                    if s in d['meth_chg'][individual]:
-                        line = [d['chrom'], d['pos'], d['genotype'][individual][s], 'CHG']
-                        w_methylatedReads = d['meth_chg']['w']['methylatedReads'][individual][s]
-                        w_coverage = d['meth_chg']['w']['coverage'][individual][s]
-                        w_phredScore = d['meth_chg']['w']['phredScore'][individual][s]
-                        w_methRatio = round(w_methylatedReads/w_coverage, 2) if w_methylatedReads and w_coverage else None
-                        c_methylatedReads = d['meth_chg']['c']['methylatedReads'][individual][s]
-                        c_coverage = d['meth_chg']['c']['coverage'][individual][s]
-                        c_phredScore = d['meth_chg']['c']['phredScore'][individual][s]
-                        c_methRatio = round(c_methylatedReads/c_coverage, 2) if c_methylatedReads and c_coverage else None
-                        methylatedReads = sum(filter(None, [w_methylatedReads, c_methylatedReads]))
-                        coverage = sum(filter(None, [w_coverage, c_coverage]))
-                        if not w_phredScore:
-                            phredScore = c_phredScore
-                        elif not c_phredScore:
-                            phredScore = w_phredScore
-                        else:
-                            phredScore = int(sum([w_phredScore, c_phredScore])/2)
-                        methRatio = round(methylatedReads/coverage, 2)
-                        meth_ratio[round(methRatio, 1)][sample] += 1
-                        meth_ratio[sample].append(round(methRatio, 1))
-                        with open(os.path.join(meth_chg, sample + '.tsv'), 'at') as handle:
-                            line += [w_methylatedReads, w_coverage, w_phredScore, c_methylatedReads, c_coverage, c_phredScore, methylatedReads, coverage, phredScore, w_methRatio, c_methRatio, methRatio]
-                            line = [str(value) if value else '.' for value in line]
-                            line = '\t'.join(line) + '\n'
-                            handle.write(line)
-        if len(samples) >= 2 and 'diffmeth_cg' in d:
-            diffmeth_cg = os.path.join(output, 'diffmeth', "_".join(region))
-            if not os.path.exists(diffmeth_cg): os.makedirs(diffmeth_cg)
-            intraindividual_file = os.path.join(diffmeth_cg, 'intraindividual.tsv')
-            interindividual_file = os.path.join(diffmeth_cg, 'interindividual.tsv')
-            has_intraindividual = False
-            has_interindividual = False
-            if not os.path.exists(intraindividual_file):
-                with open(os.path.join(diffmeth_cg, 'intraindividual' + '.tsv'), 'wt') as handle:
-                    header = ['chrom', 'pos', 'methContext', 'sample1', 'sample2', 'method', 'pValue', 'consensus']
-                    header = '\t'.join(header) + '\n'
-                    handle.write(header)
-            if not os.path.exists(interindividual_file):
-                with open(os.path.join(diffmeth_cg, 'interindividual' + '.tsv'), 'wt') as handle:
-                    header = ['chrom', 'pos', 'methContext', 'sample1', 'sample2', 'method', 'pValue', 'consensus']
-                    header = '\t'.join(header) + '\n'
-                    handle.write(header)
-            for pair in list(itertools.combinations(samples, 2)):
-                tmp1, tmp2 = pair
-                individual1, sample1 = tmp1.split('.')
-                individual2, sample2 = tmp2.split('.')
-                individual_pair = '#'.join([individual1, individual2])
-                sample_pair = '#'.join([sample1, sample2])
-                pair_kind = 'intraindividual' if individual1 == individual2 else 'interindividual'
-                if individual_pair in d['diffmeth_cg']:
-                    if sample_pair in d['diffmeth_cg'][individual_pair]:
-                        if pair_kind == 'intraindividual':
-                            has_intraindividual = True
-                        else:
-                            has_interindividual = True
-                        with open(os.path.join(diffmeth_cg, pair_kind + '.tsv'), 'at') as handle:
-                            pvalues = d['diffmeth_cg'][individual_pair][sample_pair]
-                            for method in pvalues:
-                                pvalue = pvalues[method]
-                                line = [d['chrom'], d['pos'], 'CG', tmp1, tmp2, method, pvalue, 'True' if len(pvalues) == 3 else 'False']
-                                line = [str(value) if value else '.' for value in line]
-                                line = '\t'.join(line) + '\n'
-                                handle.write(line)
-            if not has_intraindividual:
-                os.remove(intraindividual_file)
-            if not has_interindividual:
-                os.remove(interindividual_file)
-        if len(samples) >= 2 and 'diffmeth_chg' in d:
-            diffmeth_chg = os.path.join(output, 'diffmeth', "_".join(region))
-            if not os.path.exists(diffmeth_chg): os.makedirs(diffmeth_chg)
-            intraindividual_file = os.path.join(diffmeth_chg, 'intraindividual.tsv')
-            interindividual_file = os.path.join(diffmeth_chg, 'interindividual.tsv')
-            has_intraindividual = False
-            has_interindividual = False
-            if not os.path.exists(intraindividual_file):
-                with open(os.path.join(diffmeth_chg, 'intraindividual' + '.tsv'), 'wt') as handle:
-                    header = ['chrom', 'pos', 'methContext', 'sample1', 'sample2', 'method', 'pValue', 'consensus']
-                    header = '\t'.join(header) + '\n'
-                    handle.write(header)
-            if not os.path.exists(interindividual_file):
-                with open(os.path.join(diffmeth_chg, 'interindividual' + '.tsv'), 'wt') as handle:
-                    header = ['chrom', 'pos', 'methContext', 'sample1', 'sample2', 'method', 'pValue', 'consensus']
-                    header = '\t'.join(header) + '\n'
-                    handle.write(header)
-            for pair in list(itertools.combinations(samples, 2)):
-                tmp1, tmp2 = pair
-                individual1, sample1 = tmp1.split('.')
-                individual2, sample2 = tmp2.split('.')
-                individual_pair = '#'.join([individual1, individual2])
-                sample_pair = '#'.join([sample1, sample2])
-                pair_kind = 'intraindividual' if individual1 == individual2 else 'interindividual'
-                if individual_pair in d['diffmeth_chg']:
-                    if sample_pair in d['diffmeth_chg'][individual_pair]:
-                        if pair_kind == 'intraindividual':
-                            has_intraindividual = True
-                        else:
-                            has_interindividual = True
-                        with open(os.path.join(diffmeth_chg, pair_kind + '.tsv'), 'at') as handle:
-                            pvalues = d['diffmeth_chg'][individual_pair][sample_pair]
-                            for method in pvalues:
-                                pvalue = pvalues[method]
-                                line = [d['chrom'], d['pos'], 'CHG', tmp1, tmp2, method, pvalue, 'True' if len(pvalues) == 3 else 'False']
-                                line = [str(value) if value else '.' for value in line]
-                                line = '\t'.join(line) + '\n'
-                                handle.write(line)
-            if not has_intraindividual:
-                os.remove(intraindividual_file)
-            if not has_interindividual:
-                os.remove(interindividual_file)
-    with open(os.path.join(stats, 'summary_stat.tsv'), 'wt') as handle:
-        header = ['#measure'] + [sample for sample in samples]
-        header = '\t'.join(header) + '\n'
-        handle.write(header)
-        if meth_ratio[sample]:
-            line = ['average'] + [statistics.mean(meth_ratio[sample]) for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-            line = ['stdev'] + [statistics.stdev(meth_ratio[sample]) if len(meth_ratio[sample]) >=2 else '.' for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-            line = ['p10'] + [percentile(meth_ratio[sample], 0.1) for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-            line = ['p25'] + [percentile(meth_ratio[sample], 0.25) for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-            line = ['p50'] + [statistics.median(meth_ratio[sample]) for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-            line = ['p75'] + [percentile(meth_ratio[sample], 0.75) for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-            line = ['p90'] + [percentile(meth_ratio[sample], 0.9) for sample in samples]
-            line = [str(value) if value else '.' for value in line]
-            line = '\t'.join(line) + '\n'
-            handle.write(line)
-    with open(os.path.join(stats, 'histogram.tsv'), 'wt') as handle:
-        header = ['#methRatio'] + [sample for sample in samples]
-        header = '\t'.join(header) + '\n'
-        handle.write(header)
-        if meth_ratio[sample]:
-            for n in range(0, 11, 1):
-                n = n / 10
-                line = [str(n)] + [meth_ratio[n][sample] for sample in samples]
-                line = [str(value) if value else '0' for value in line]
-                line = '\t'.join(line) + '\n'
-                handle.write(line)
-    logger.info('Done')
-    # Methylation segments analysis
-    query = region[0] + ":" + region[1] + "-" + region[2]
-    url = os.path.join(os.path.join(server, 'segments', args.percentile), assembly, query)
-    logger.info('Methylation segments - GET: ' + url)
-    n = 0
-    while True:
-        try:
-            res = requests.get(url)
-            break
-        except:
-            n += 1
-            if n < retries:
-                logger.warning('Internet connection failed. Retrying...')
-            else:
-                logger.critical('Unable to connect to the Internet! Leaving the program...')
-                raise SystemExit
-    if res.status_code != 200:
-        logger.error('API Error: ' + str(res.status_code))
-        logger.critical('Unable to reach the NGSmethDB API Server! Leaving the program...')
-        raise SystemExit
-    data = res.json()
-    if not data:
-        logger.warning('No data available in this region!')
-        progress(bar, region, index + 1, total)
-        return
-    logger.info('Calculating...')
-    segments = os.path.join(output, 'segments')
-    segments_dir = True
-    if not os.path.exists(segments):
-        segments_dir = False
-        os.makedirs(segments)
-    lines = []
-    for d in data:
-        for s in samples:
-            individual, sample = s.split('.')
-            if individual in d['samples']:
-                if sample in d['samples'][individual]:
-                    line = '\t'.join([d['chrom'], str(d['start']), str(d['end']), 'CG', str(d['samples']['sampleCount']), s, str(d['samples'][individual][sample]['methRatio'])]) + '\n'
-                    lines.append(line)
-    if lines:
-        with open(os.path.join(segments, '_'.join(region) + '.tsv'), 'wt') as handle:
-            handle.write('#chrom\tstart\tend\tmethContext\tsampleCount\tsample\tsample.methRatio\n')
-            handle.writelines(lines)
-    else:
-        if not segments_dir:
-            shutil.rmtree(segments)
-    logger.info('Done')
-    # /Methylation segments analysis
-    progress(bar, 'Done', index + 1, total)
-    if index == total - 1 and not display:
-        bar.gauge_stop()
+class BatchProgress:
+    '''
+    Progress of a --batch run on stderr, as plain text or JSON lines, at most
+    once every interval seconds plus a final report.
+    '''
+
+    def __init__(self, progress_format = 'text', interval = 10):
+        self.format = progress_format
+        self.interval = interval
+        self.started = time.monotonic()
+        self.reported = None
+
+    def update(self, message, index, total, failed, final = False):
+        now = time.monotonic()
+        if not final and self.reported is not None and now - self.reported < self.interval:
+            return
+        self.reported = now
+        percentage = int((index / total) * 100) if total else 100
+        if self.format == 'json':
+            line = json.dumps({'done': index, 'total': total, 'percent': percentage, 'failed': failed, 'elapsed': round(now - self.started, 1), 'message': message})
+        else:
+            line = '[{}%] {}/{} regions, {} failed, {:.0f} s - {}'.format(percentage, index, total, failed, now - self.started, message)
+        sys.stderr.write(line + '\n')
+        sys.stderr.flush()
 
 def finish():
     message = 'Work done. Leaving the program...'
     logger.info(message)
+    if args.batch:
+        return
     if display:
         bar = PyZenity.Progress(title = title, text = message, percentage = 0, auto_close = True)
         total = 10
@@ -475,45 +2061,185 @@ def finish():
         bar = dialog.Dialog(dialog = 'dialog' if not OS.startswith('win') else os.path.join(os.path.dirname(os.path.realpath(__file__)), 'windows', 'dialog.exe'), autowidgetsize = False)
         bar.pause(text = message, seconds = 10, no_cancel = True)
 
-def main(args):
+def main(args, profiler = None):
+
+    client = NGSmethDBClient(args.server, connect_timeout = args.connect_timeout, read_timeout = args.read_timeout, retries = args.retries,
+                             backoff = args.backoff, backoff_max = args.backoff_max, retry_statuses = args.retry_statuses,
+                             host_connections = args.host_connections, cache_dir = args.cache_dir, cache_size = args.cache_size,
+                             cache_ttl = args.cache_ttl, offline = args.offline, stream = args.stream,
+                             catalog_dir = args.catalog_dir or None, catalog_ttl = args.catalog_ttl, chunk_size = args.chunk_size,
+                             chunk_jobs = args.chunk_jobs, rate = args.rate, burst = args.burst, adaptive = args.adaptive)
 
     if args.config:
         assembly, samples = config_parser(args.config)
+        check_config(client, assembly, samples)
     else:
         logger.warning("No configuration file given! Asking for some options...")
         welcome(display)
-        assembly = get_assembly(args.server)
-        samples = get_samples(assembly, args.server)
+        assembly = get_assembly(client)
+        samples = get_samples(client, assembly)
         save_config(assembly, samples)
 
+    try:
+        regions = read_bed(args.input, sort = args.sort)
+    except (OSError, EOFError, BEDError) as error:
+        logger.critical('INVALID BED FILE! {}. Leaving the program...'.format(error))
+        raise SystemExit(1)
+    logger.info("Number of regions in BED file: {}".format(len(regions)))
+    if args.shard:
+        regions = shard_regions(regions, args.shard[0], args.shard[1], args.merge_span, args.merge_gap)
+        logger.info("Shard {}/{}: {} regions, {} bp".format(args.shard[0], args.shard[1], len(regions), sum(int(end) - int(start) + 1 for chrom, start, end in regions)))
     index = 0
-    total = get_total(args.input)
-    logger.info("Number of regions in BED file: {}".format(total))
+    total = len(regions)
+
+    run = RegionRun(client, assembly, samples, args.output, percentiles = args.percentile, output_format = args.output_format,
+                    flush_rows = args.flush_rows, resume = args.resume, meth = not args.segments_only, segments = not args.skip_segments,
+                    profiler = profiler)
+    if args.resume:
+        logger.info("Regions already completed: {}".format(len(run.completed)))
+        index = sum(1 for region in regions if region in run.completed)
 
-    if not display:
+    if args.batch:
+        bar = BatchProgress(args.progress_format, args.progress_interval)
+        signal.signal(signal.SIGINT, functools.partial(batch_signal_handler, run))
+        signal.signal(signal.SIGTERM, functools.partial(batch_signal_handler, run))
+    elif not display:
         bar = dialog.Dialog(dialog = 'dialog' if not OS.startswith('win') else os.path.join(os.path.dirname(os.path.realpath(__file__)), 'windows', 'dialog.exe'), autowidgetsize = False)
         bar.set_background_title("NSGmethDB API Client")
     else:
         bar = PyZenity.Progress(title = title, text = 'Initialising...', percentage = 0, auto_close = True)
 
-    for region in bed_reader(args.input):
-        get_region(index, total, region, assembly, samples, args.output, args.server, bar)
-        index += 1
+    if not args.batch and not display:
+        bar.gauge_start()
+
+    failed = 0
+
+    batches = run.plan(regions, args.merge_span, args.merge_gap)
+    if args.merge_span:
+        total = index + sum(len(batch[1]) for batch in batches)
+        logger.info("Number of merged queries: {}".format(len(batches)))
+
+    for (query, members), errors in run.run(batches, args.jobs):
+        index += len(members)
+        failed += errors
+        message = 'Got data from region {}:{}-{}'.format(query[0], query[1], query[2])
+        if args.batch:
+            bar.update(message, index, total, failed)
+        else:
+            progress(bar, message, index, total)
+
+    if args.batch:
+        bar.update('Interrupted' if run.stopping.is_set() else 'Done', index, total, failed, final = True)
+    elif not display:
+        bar.gauge_stop()
+
+    if failed:
+        logger.error('{} region(s) failed. See {}'.format(failed, run.failures))
+
+    summary = run.close()
+    client.close()
+
+    for line in format_summary(summary):
+        logger.info(line)
+        if args.batch:
+            sys.stderr.write(line + '\n')
+
+    if run.stopping.is_set():
+        logger.critical('Stopped before the end of the BED file. Run again with --resume to go on. Leaving the program...')
+        raise SystemExit(1)
 
     finish()
 
+    if args.batch and failed:
+        raise SystemExit(2)
+
+def merge(args):
+    '''
+    The merge command: combines the output directories of --shard runs.
+    '''
+    try:
+        regions = read_bed(args.input) if args.input else None
+        result = merge_runs(args.shards, args.output, regions, link = args.link)
+    except (OSError, EOFError, BEDError, ValueError) as error:
+        logger.critical('Unable to merge the shards! {}. Leaving the program...'.format(error))
+        raise SystemExit(1)
+    logger.info('Merged {} shards into {}: {} files, {} completed regions, {} failed'.format(result['shards'], args.output, result['files'], result['completed'], result['failed']))
+    for line in format_summary(result['metrics']):
+        logger.info(line)
+    if result['failed']:
+        logger.error('{} region(s) failed. See {}'.format(result['failed'], os.path.join(args.output, 'failed_regions.bed')))
+    if result['missing']:
+        logger.error('{} region(s) of {} are in no shard, e.g. {}:{}-{}'.format(len(result['missing']), args.input, *result['missing'][0]))
+    if result['failed'] or result['missing']:
+        raise SystemExit(2)
+
 if __name__ == '__main__':
 
-    import argparse, logging, os, sys, signal
+    import argparse, signal
 
-    parser = argparse.ArgumentParser(prog='NGSmethDB API Client')
-    parser.add_argument('-i', '--input', type=argparse.FileType('r'), help='\x1b[33mBED File (mandatory)\x1b[0m')
+    if sys.argv[1:2] == ['merge']:
+        parser = argparse.ArgumentParser(prog='NGSmethDB API Client merge', description='Combines the output directories of --shard runs into one')
+        parser.add_argument('shards', nargs='+', help='Output directories of the shards')
+        parser.add_argument('-o', '--output', type=str, required=True, help='Merged output directory')
+        parser.add_argument('-i', '--input', type=str, help='BED file of the whole run, to report the regions no shard completed')
+        parser.add_argument('--link', action='store_true', help='Hard link the region files and dataset parts instead of copying them')
+        merge_args = parser.parse_args(sys.argv[2:])
+        make_outdir(merge_args.output)
+        logger.setLevel(logging.DEBUG)
+        fh = logging.FileHandler(os.path.join(merge_args.output, 'NGSmethDB_API_client.log'))
+        fh.setLevel(logging.DEBUG)
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        fh.setFormatter(formatter)
+        ch.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(fh)
+        logger.addHandler(ch)
+        merge(merge_args)
+        raise SystemExit
+
+    parser = argparse.ArgumentParser(prog='NGSmethDB API Client', epilog='To combine the output directories of --shard runs: %(prog)s merge -h')
+    parser.add_argument('-i', '--input', type=str, help='\x1b[33mBED File, plain or gzip/bgzip compressed, - for stdin (mandatory)\x1b[0m')
     parser.add_argument('-o', '--output', type=str, help='\x1b[33mOutput Directory (mandatory)\x1b[0m')
     parser.add_argument('-c', '--config', type=argparse.FileType('r'), help='\x1b[33mConfiguration File (optional)\x1b[0m')
-    parser.add_argument('-r', '--server', type=str, default='http://bioinfo2.ugr.es:8888/NGSmethAPI', help='NGSmethDB API Server')
+    parser.add_argument('-r', '--server', type=str, default=DEFAULT_SERVER, help='NGSmethDB API Server')
     parser.add_argument('-d', '--dialog', action='store_true', help='Do not try to use Zenity. Use dialog instead')
-    parser.add_argument('-p', '--percentile', type=str, default='95', help='Methylation segments percentile threshold')
-    parser.add_argument('--version', action='version', version='%(prog)s 0.2.0')
+    parser.add_argument('-p', '--percentile', type=lambda value: list(collections.OrderedDict.fromkeys(percentile.strip() for percentile in value.split(',') if percentile.strip())), default=['95'], help='Comma-separated methylation segments percentile threshold(s). With several, segments go to segments/p<NN>/')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of regions to fetch concurrently')
+    parser.add_argument('--host-connections', type=int, default=4, help='Maximum number of simultaneous requests to the API server')
+    parser.add_argument('--rate', type=float, default=0, help='Maximum number of API requests started per second (0: no limit)')
+    parser.add_argument('--burst', type=int, help='Requests that can be started at once before --rate applies (default: one second of --rate)')
+    parser.add_argument('--adaptive', action='store_true', help='Adapt the requests in flight (up to --host-connections) to the server: halve them on 429/5xx, connection errors or latency spikes, and raise them while it is healthy')
+    parser.add_argument('--connect-timeout', type=float, default=10, help='Seconds to wait for a connection to the API server')
+    parser.add_argument('--read-timeout', type=float, default=120, help='Seconds to wait for an API response')
+    parser.add_argument('--retries', type=int, default=10, help='Maximum number of attempts per API request')
+    parser.add_argument('--backoff', type=float, default=0.5, help='Initial delay in seconds between retries (doubled on every attempt)')
+    parser.add_argument('--backoff-max', type=float, default=60, help='Maximum delay in seconds between retries')
+    parser.add_argument('--retry-statuses', type=lambda value: set(int(code) for code in value.split(',')), default={429, 500, 502, 503, 504}, help='Comma-separated HTTP status codes to retry (default: 429,500,502,503,504)')
+    parser.add_argument('--cache-dir', type=str, help='Directory where API responses are cached between runs')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Maximum size of the response cache in MB')
+    parser.add_argument('--cache-ttl', type=int, default=604800, help='Seconds before a cached response is downloaded again (0: never)')
+    parser.add_argument('--offline', action='store_true', help='Use only cached responses. Never contact the API server')
+    parser.add_argument('--catalog-dir', type=str, default=DEFAULT_CATALOG_DIR, help='Directory where the assembly and sample catalog is kept (empty: do not keep it)')
+    parser.add_argument('--catalog-ttl', type=int, default=3600, help='Seconds before the kept catalog is revalidated with the server')
+    parser.add_argument('--sort', action='store_true', help='Sort the BED regions by chromosome and position and drop duplicates')
+    parser.add_argument('--resume', action='store_true', help='Skip regions completed by a previous run into the same output directory')
+    parser.add_argument('--merge-span', type=int, default=0, help='Merge nearby regions into API queries of up to this many bp (0: one query per region)')
+    parser.add_argument('--merge-gap', type=int, default=1000, help='Maximum distance in bp between regions merged into the same query')
+    parser.add_argument('--shard', type=str, help='Only fetch shard K of N (K/N, 1 <= K <= N) of the BED regions, balanced by length. Combine the shards with the merge command')
+    parser.add_argument('--chunk-size', type=int, default=1000000, help='Query regions longer than this many bp in chunks (0: never split)')
+    parser.add_argument('--chunk-jobs', type=int, default=1, help='Number of chunks of a region to fetch concurrently')
+    parts = parser.add_mutually_exclusive_group()
+    parts.add_argument('--skip-segments', action='store_true', help='Do not download the methylation segments')
+    parts.add_argument('--segments-only', action='store_true', help='Only download the methylation segments')
+    parser.add_argument('--stream', action='store_true', help='Parse API responses incrementally instead of loading them whole')
+    parser.add_argument('-f', '--output-format', choices=['tsv', 'tsv.gz', 'parquet'], default='tsv', help='tsv: files per region and sample (default). tsv.gz/parquet: one dataset per table, split by chromosome')
+    parser.add_argument('--flush-rows', type=int, default=1000000, help='Rows buffered before writing a new part file with --output-format tsv.gz/parquet')
+    parser.add_argument('--batch', action='store_true', help='Run without any user interface (requires --config): progress on stderr, no final pause, clean stop on SIGINT/SIGTERM')
+    parser.add_argument('--progress-format', choices=['text', 'json'], default='text', help='Format of the --batch progress reports')
+    parser.add_argument('--progress-interval', type=float, default=10, help='Minimum seconds between --batch progress reports')
+    parser.add_argument('--profile', action='store_true', help='Profile the run with cProfile (every thread) into stats/profile.pstats and stats/profile.pstats.txt')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
     global args
     args = parser.parse_args()
 
@@ -521,23 +2247,52 @@ if __name__ == '__main__':
         parser.print_help()
         raise SystemExit
 
+    if args.jobs < 1 or args.host_connections < 1 or args.retries < 1 or args.chunk_jobs < 1:
+        parser.error('--jobs, --host-connections, --retries and --chunk-jobs must be at least 1')
+
+    if args.offline and not args.cache_dir:
+        parser.error('--offline requires --cache-dir')
 
+    if args.rate < 0 or args.burst is not None and args.burst < 1:
+        parser.error('--rate cannot be negative and --burst must be at least 1')
+
+    if not args.percentile:
+        parser.error('--percentile needs at least one value')
+    for percentile in args.percentile:
+        try:
+            if not math.isfinite(float(percentile)):
+                raise ValueError
+        except ValueError:
+            parser.error('--percentile must be numbers, not {!r}'.format(percentile))
 
-    signal.signal(signal.SIGINT, signal_handler)
+    if args.batch and not args.config:
+        parser.error('--batch requires --config')
+
+    if args.shard:
+        try:
+            args.shard = tuple(int(value) for value in args.shard.split('/'))
+        except ValueError:
+            args.shard = ()
+        if len(args.shard) != 2 or not 1 <= args.shard[0] <= args.shard[1]:
+            parser.error('--shard must be K/N with 1 <= K <= N')
+
+
+    if args.batch:
+        # Nothing to finish before the run starts (see batch_signal_handler), and no one to ask
+        signal.signal(signal.SIGINT, exit_signal_handler)
+        signal.signal(signal.SIGTERM, exit_signal_handler)
+    else:
+        signal.signal(signal.SIGINT, signal_handler)
 
     global title
     title = 'NGSmethDB API Client'
 
-    global retries
-    retries = 10
-
     global display
     display = 'DISPLAY' in os.environ
-    if args.dialog: display = False
+    if args.dialog or args.batch: display = False
 
     if args.output: make_outdir(args.output)
 
-    logger = logging.getLogger('NGSmethDB API Client')
     logger.setLevel(logging.DEBUG)
     fh = logging.FileHandler(os.path.join(args.output if args.output else os.getcwd(), 'NGSmethDB_API_client.log'))
     fh.setLevel(logging.DEBUG)
@@ -555,10 +2310,26 @@ if __name__ == '__main__':
         logger.critical('Python version not supported! Leaving the program...')
         raise SystemExit
 
-    import shutil, time, subprocess, json, csv, itertools, collections, statistics, math, functools, dialog, PyZenity, requests
+    if not args.batch:
+        import dialog, PyZenity
+
+    if args.output_format == 'parquet':
+        try:
+            importlib.import_module('pyarrow.parquet')
+        except ImportError:
+            logger.critical('pyarrow is required for --output-format parquet! Leaving the program...')
+            raise SystemExit(1)
 
     global OS
     OS = sys.platform
     logger.info('OS / platform: {}'.format(OS))
 
-    main(args)
+    if args.profile:
+        profiler = Profiler()
+        try:
+            profiler.wrap(main)(args, profiler)
+        finally:
+            profiler.save(os.path.join(args.output, 'stats', 'profile.pstats'))
+            logger.info('Profile written to ' + os.path.join(args.output, 'stats', 'profile.pstats'))
+    else:
+        main(args)
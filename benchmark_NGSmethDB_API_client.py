@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+'''
+Throughput benchmark of NGSmethDB_API_client.py against the local mock API
+server (mock_NGSmethDB_API_server.py). Every scenario runs the client in
+--batch mode on the same synthetic BED file and reports regions/s, rows/s,
+peak RSS and the number of output files. Results can be saved as JSON and
+compared with a previous run to catch regressions.
+'''
+
+import argparse, gzip, json, os, shutil, subprocess, sys, tempfile, threading, time
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, HERE)
+import mock_NGSmethDB_API_server as mock
+
+SCENARIOS = ('serial', 'concurrent', 'cached', 'stream')
+
+def write_bed(path, regions, length, chroms, gap):
+    with open(path, 'wt') as handle:
+        for n in range(regions):
+            chrom = 'chr{}'.format(n % chroms + 1)
+            start = (n // chroms) * (length + gap) + 10000
+            handle.write('{}\t{}\t{}\n'.format(chrom, start, start + length))
+
+def scenario_args(scenario, jobs, cache_dir):
+    if scenario == 'serial':
+        return ['-j', '1']
+    if scenario == 'concurrent':
+        return ['-j', str(jobs)]
+    if scenario == 'cached':
+        return ['-j', str(jobs), '--cache-dir', cache_dir, '--offline']
+    if scenario == 'stream':
+        return ['-j', str(jobs), '--stream']
+    raise ValueError('Unknown scenario: ' + scenario)
+
+def run_client(args):
+    '''
+    Runs the client, returning its exit status, wall time and peak RSS (MB).
+    '''
+    # stderr goes to a file: a pipe would fill up (and block the client) while waiting for it
+    with tempfile.TemporaryFile() as stderr:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(HERE, 'NGSmethDB_API_client.py')] + args, stdout = subprocess.DEVNULL, stderr = stderr)
+        if hasattr(os, 'wait4'):
+            pid, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            rss = usage.ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+        else:
+            process.wait()
+            rss = None
+        elapsed = time.perf_counter() - started
+        stderr.seek(0)
+        errors = stderr.read().decode(errors = 'replace')
+    return process.returncode, elapsed, rss, errors
+
+def count_rows(path):
+    if path.endswith('.tsv'):
+        with open(path, 'rb') as handle:
+            return max(0, sum(1 for line in handle) - 1)
+    if path.endswith('.tsv.gz'):
+        with gzip.open(path, 'rb') as handle:
+            return max(0, sum(1 for line in handle) - 1)
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return 0
+        return pyarrow.parquet.read_metadata(path).num_rows
+    return 0
+
+def count_output(output):
+    '''
+    Number of output files and of data rows in meth, diffmeth and segments.
+    '''
+    files = rows = 0
+    for root, dirs, names in os.walk(output):
+        files += len(names)
+        top = os.path.relpath(root, output).split(os.sep)[0]
+        if top in ('meth', 'diffmeth', 'segments'):
+            rows += sum(count_rows(os.path.join(root, name)) for name in names)
+    return files, rows
+
+def benchmark(args):
+    work = args.work_dir or tempfile.mkdtemp(prefix = 'NGSmethDB_benchmark_')
+    os.makedirs(work, exist_ok = True)
+    server = mock.make_server(mock.parse_args(['--port', '0', '--latency', str(args.latency), '--jitter', str(args.jitter), '--error-rate', str(args.error_rate),
+                                               '--spacing', str(args.spacing), '--individuals', str(args.individuals), '--samples', str(args.samples),
+                                               '--contexts', args.contexts, '--memoize']))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    url = 'http://{}:{}/NGSmethAPI'.format(*server.server_address[:2])
+    bed = os.path.join(work, 'regions.bed')
+    write_bed(bed, args.regions, args.region_length, args.chroms, args.gap)
+    config = os.path.join(work, 'config.json')
+    with open(config, 'wt') as handle:
+        json.dump({'assembly': 'hg38', 'samples': [individual + '.' + sample for individual, samples in server.catalog.items() for sample in samples]}, handle)
+    cache_dir = os.path.join(work, 'cache')
+    common = ['-i', bed, '-c', config, '-r', url, '--batch', '--progress-interval', '3600', '--catalog-dir', os.path.join(work, 'catalog'), '--retries', '20', '--backoff', '0.05']
+    common += args.client_args.split()
+    results = []
+    print('{:<11} {:>8} {:>10} {:>10} {:>12} {:>10} {:>7} {:>6}'.format('scenario', 'seconds', 'regions/s', 'rows', 'rows/s', 'RSS (MB)', 'files', 'status'), flush = True)
+    try:
+        if not args.no_warmup:
+            # Untimed run, so the mock server has every response ready and only the client is measured
+            warm = os.path.join(work, 'warm')
+            run_client(common + ['-o', warm, '-j', str(args.jobs)])
+            shutil.rmtree(warm, ignore_errors = True)
+        for scenario in args.scenarios:
+            if scenario == 'cached':
+                # Warm the cache with an untimed run
+                warm = os.path.join(work, 'warm')
+                run_client(common + ['-o', warm, '-j', str(args.jobs), '--cache-dir', cache_dir])
+                shutil.rmtree(warm, ignore_errors = True)
+            for repeat in range(args.repeat):
+                output = os.path.join(work, '{}-{}'.format(scenario, repeat))
+                shutil.rmtree(output, ignore_errors = True)
+                status, elapsed, rss, errors = run_client(common + ['-o', output] + scenario_args(scenario, args.jobs, cache_dir))
+                files, rows = count_output(output)
+                result = {'scenario': scenario, 'repeat': repeat, 'status': status, 'seconds': round(elapsed, 3), 'regions_per_s': round(args.regions / elapsed, 2),
+                          'rows': rows, 'rows_per_s': round(rows / elapsed, 1), 'peak_rss_mb': round(rss, 1) if rss is not None else None, 'files': files}
+                if status:
+                    result['errors'] = errors.strip().splitlines()[-3:]
+                results.append(result)
+                print_result(result)
+                if not args.keep:
+                    shutil.rmtree(output, ignore_errors = True)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work, ignore_errors = True)
+    return results
+
+def print_result(result):
+    rss = '{:.1f}'.format(result['peak_rss_mb']) if result['peak_rss_mb'] is not None else '-'
+    print('{:<11} {:>8.2f} {:>10.1f} {:>10} {:>12.0f} {:>10} {:>7} {:>6}'.format(result['scenario'], result['seconds'], result['regions_per_s'], result['rows'],
+                                                                           result['rows_per_s'], rss, result['files'], result['status']), flush = True)
+
+def best(results):
+    scores = {}
+    for result in results:
+        if not result['status']:
+            scores[result['scenario']] = max(scores.get(result['scenario'], 0), result['regions_per_s'])
+    return scores
+
+def compare(results, baseline, tolerance):
+    '''
+    Scenarios slower than the baseline by more than tolerance (a fraction).
+    '''
+    regressions = []
+    current = best(results)
+    for scenario, reference in best(baseline).items():
+        if scenario in current and current[scenario] < reference * (1 - tolerance):
+            regressions.append('{}: {:.1f} regions/s (baseline {:.1f})'.format(scenario, current[scenario], reference))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='NGSmethDB API Client benchmark')
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS), help='Comma-separated scenarios: {} (default: all)'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--regions', type=int, default=200, help='Number of BED regions')
+    parser.add_argument('--region-length', type=int, default=5000, help='Length of every region in bp')
+    parser.add_argument('--chroms', type=int, default=3, help='Number of chromosomes the regions are spread over')
+    parser.add_argument('--gap', type=int, default=20000, help='Distance in bp between consecutive regions of a chromosome')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='--jobs of the concurrent, cached and stream scenarios')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per scenario (the best one is compared with the baseline)')
+    parser.add_argument('--latency', type=float, default=0.02, help='Latency of the mock server in seconds')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra latency of the mock server in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of mock server responses that fail with 503')
+    parser.add_argument('--spacing', type=int, default=10, help='Distance in bp between methylation records (payload size)')
+    parser.add_argument('--individuals', type=int, default=2, help='Number of individuals in the mock catalog')
+    parser.add_argument('--samples', type=int, default=2, help='Number of samples per individual (all are queried)')
+    parser.add_argument('--contexts', type=str, default='CG,CHG', help='Comma-separated methylation contexts served')
+    parser.add_argument('--client-args', type=str, default='', help='Extra arguments for every client run, e.g. "--output-format parquet"')
+    parser.add_argument('--work-dir', type=str, help='Directory for the BED file, cache and outputs (default: a temporary one)')
+    parser.add_argument('--no-warmup', action='store_true', help='Do not prepare the mock server responses with an untimed run first')
+    parser.add_argument('--keep', action='store_true', help='Keep the outputs of every run')
+    parser.add_argument('--json', type=str, help='Save the results to this JSON file')
+    parser.add_argument('--baseline', type=str, help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown (fraction of regions/s) tolerated against the baseline')
+    args = parser.parse_args()
+
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenario(s): ' + ', '.join(unknown))
+
+    results = benchmark(args)
+    if args.json:
+        with open(args.json, 'wt') as handle:
+            json.dump({'version': 1, 'arguments': vars(args), 'results': results}, handle, indent = 2)
+    failed = [result for result in results if result['status']]
+    for result in failed:
+        print('{} run failed (exit status {}): {}'.format(result['scenario'], result['status'], ' / '.join(result.get('errors', []))), file = sys.stderr)
+    if args.baseline:
+        with open(args.baseline, 'rt') as handle:
+            regressions = compare(results, json.load(handle)['results'], args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file = sys.stderr)
+        if regressions:
+            raise SystemExit(1)
+    if failed:
+        raise SystemExit(2)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+'''
+Local stand-in for the NGSmethDB API, for tests and benchmarks of
+NGSmethDB_API_client.py. It serves synthetic data with the JSON shape of
+the real endpoints (info, version, <assembly>/samples, <assembly>/<region>
+and segments/<percentile>/<assembly>/<region>). Payloads are deterministic:
+the same query always gets the same answer.
+'''
+
+import argparse, gzip, hashlib, json, random, re, time, zlib, urllib.parse, http.server, socketserver
+
+def sample_catalog(individuals, samples):
+    return dict(('ind{}'.format(i + 1), ['s{}'.format(s + 1) for s in range(samples)]) for i in range(individuals))
+
+def position_rng(seed, chrom, pos):
+    return random.Random(zlib.crc32('{}:{}:{}'.format(seed, chrom, pos).encode()))
+
+def strand_counts(rng, coverage_max):
+    coverage = rng.randint(0, coverage_max)
+    if not coverage:
+        return None, None, None
+    return rng.randint(0, coverage), coverage, rng.randint(0, 40)
+
+def meth_records(args, chrom, start, end, samples):
+    '''
+    One record per methylated position in [start, end]: every args.spacing bp,
+    with CG data for every sample and CHG/CHH data on some positions.
+    '''
+    pairs = [(a, b) for n, a in enumerate(samples) for b in samples[n + 1:]]
+    records = []
+    for pos in range(start + (-start) % args.spacing, end + 1, args.spacing):
+        rng = position_rng(args.seed, chrom, pos)
+        d = {'chrom': chrom, 'pos': pos, 'genotype': {}}
+        for context in args.contexts:
+            if context != 'CG' and rng.random() > 0.3:
+                continue
+            m = {'w': {'methylatedReads': {}, 'coverage': {}, 'phredScore': {}}, 'c': {'methylatedReads': {}, 'coverage': {}, 'phredScore': {}}}
+            for sample in samples:
+                individual, s = sample.split('.')
+                d['genotype'].setdefault(individual, {}).setdefault(s, context)
+                m.setdefault(individual, {})[s] = True
+                for strand in 'wc':
+                    methylated, coverage, phred = strand_counts(rng, args.coverage)
+                    m[strand]['methylatedReads'].setdefault(individual, {})[s] = methylated
+                    m[strand]['coverage'].setdefault(individual, {})[s] = coverage
+                    m[strand]['phredScore'].setdefault(individual, {})[s] = phred
+                if not (m['w']['coverage'][individual][s] or m['c']['coverage'][individual][s]):
+                    m['w']['coverage'][individual][s] = 1
+                    m['w']['methylatedReads'][individual][s] = rng.randint(0, 1)
+            d['meth_' + context.lower()] = m
+            if pairs and rng.random() < args.dmc_rate:
+                dm = {}
+                for sample1, sample2 in pairs:
+                    individual1, s1 = sample1.split('.')
+                    individual2, s2 = sample2.split('.')
+                    methods = ['fisher', 'binomial', 'mann'][:rng.randint(1, 3)]
+                    dm.setdefault(individual1 + '#' + individual2, {})[s1 + '#' + s2] = dict((method, round(rng.random() / 20, 4)) for method in methods)
+                d['diffmeth_' + context.lower()] = dm
+        records.append(d)
+    return records
+
+def segment_records(args, chrom, start, end, percentile, samples):
+    '''
+    Consecutive segments of args.segment bp overlapping [start, end].
+    '''
+    records = []
+    for segment in range(start - start % args.segment, end + 1, args.segment):
+        rng = position_rng(args.seed + percentile, chrom, segment)
+        d = {'chrom': chrom, 'start': segment, 'end': segment + args.segment - 1, 'samples': {'sampleCount': len(samples)}}
+        for sample in samples:
+            individual, s = sample.split('.')
+            d['samples'].setdefault(individual, {})[s] = {'methRatio': round(rng.random(), 2)}
+        records.append(d)
+    return records
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *values):
+        if self.server.args.verbose:
+            super().log_message(format, *values)
+
+    def do_GET(self):
+        args = self.server.args
+        if args.latency:
+            time.sleep(args.latency + random.uniform(0, args.jitter))
+        url = urllib.parse.urlparse(self.path)
+        parts = [urllib.parse.unquote(part) for part in url.path.split('/') if part][1:]
+        query = urllib.parse.parse_qs(url.query)
+        if random.random() < args.error_rate:
+            return self.send(random.choice(args.error_statuses), {'error': 'synthetic failure'}, retry_after = args.retry_after)
+        if args.memoize and self.path in self.server.responses:
+            return self.send(200, None, body = self.server.responses[self.path])
+        catalog = self.server.catalog
+        if parts == ['info']:
+            return self.send(200, [{'assembly': assembly, 'common': 'Synthetic', 'species': 'Mock organism'} for assembly in args.assemblies])
+        if parts == ['version']:
+            return self.send(200, [{'NGSmethDB_API_client': args.client_version}])
+        if len(parts) == 2 and parts[0] in args.assemblies and parts[1] == 'samples':
+            return self.send(200, catalog)
+        if len(parts) == 4 and parts[0] == 'segments' and parts[2] in args.assemblies:
+            region = re.match(r'^([^:]+):(\d+)-(\d+)$', parts[3])
+            if region:
+                chrom, start, end = region.group(1), int(region.group(2)), int(region.group(3))
+                samples = [individual + '.' + s for individual in catalog for s in catalog[individual]]
+                return self.send(200, segment_records(args, chrom, start, end, int(float(parts[1])), samples))
+        if len(parts) == 2 and parts[0] in args.assemblies:
+            region = re.match(r'^([^:]+):(\d+)-(\d+)$', parts[1])
+            if region:
+                chrom, start, end = region.group(1), int(region.group(2)), int(region.group(3))
+                samples = [sample for sample in ','.join(query.get('samples', [])).split(',') if sample]
+                unknown = [sample for sample in samples if sample.split('.')[0] not in catalog or sample.split('.')[-1] not in catalog[sample.split('.')[0]]]
+                if unknown or not samples:
+                    return self.send(400, {'error': 'unknown samples: {}'.format(','.join(unknown))})
+                return self.send(200, meth_records(args, chrom, start, end, samples))
+        self.send(404, {'error': 'not found'})
+
+    def send(self, status, data, retry_after = None, body = None):
+        if body is None:
+            body = json.dumps(data).encode()
+            if status == 200 and self.server.args.memoize:
+                self.server.responses[self.path] = body
+        tag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:16])
+        if status == 200 and self.headers.get('If-None-Match') == tag:
+            self.send_response(304)
+            self.send_header('ETag', tag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        encoding = None
+        if status == 200 and not self.server.args.no_gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel = 1)
+            encoding = 'gzip'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', tag)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(args):
+    server = Server((args.host, args.port), Handler)
+    server.args = args
+    server.catalog = sample_catalog(args.individuals, args.samples)
+    server.responses = {}
+    return server
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(prog='NGSmethDB API mock server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8888, help='Port to listen on (0: any free port, printed on startup)')
+    parser.add_argument('--assemblies', type=lambda value: value.split(','), default=['hg38'], help='Comma-separated assemblies served')
+    parser.add_argument('--individuals', type=int, default=2, help='Number of individuals in the catalog')
+    parser.add_argument('--samples', type=int, default=2, help='Number of samples per individual')
+    parser.add_argument('--contexts', type=lambda value: value.split(','), default=['CG', 'CHG'], help='Comma-separated methylation contexts (CG, CHG, CHH)')
+    parser.add_argument('--spacing', type=int, default=10, help='Distance in bp between methylation records (payload density)')
+    parser.add_argument('--coverage', type=int, default=30, help='Maximum coverage per strand')
+    parser.add_argument('--dmc-rate', type=float, default=0.2, help='Fraction of records with differential methylation p-values')
+    parser.add_argument('--segment', type=int, default=500, help='Length in bp of the methylation segments')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='Random extra latency, up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests answered with an error status')
+    parser.add_argument('--error-statuses', type=lambda value: [int(code) for code in value.split(',')], default=[503], help='Comma-separated error statuses returned (default: 503)')
+    parser.add_argument('--retry-after', type=float, help='Retry-After header of the error responses')
+    parser.add_argument('--memoize', action='store_true', help='Keep every response in memory and serve repeated queries from there')
+    parser.add_argument('--no-gzip', action='store_true', help='Never compress responses')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+    parser.add_argument('--client-version', type=lambda value: [int(i) for i in value.split('.')], default=[0, 2, 0], help='Version announced by the version endpoint')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log every request')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = make_server(args)
+    print('Serving the mock NGSmethDB API on http://{}:{}/NGSmethAPI'.format(*server.server_address[:2]), flush = True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -4,29 +4,22 @@
 NGSmethDB website: http://bioinfo2.ugr.es:8080/NGSmethDB/
 '''
 
-import os, subprocess, requests, dialog, PyZenity
+import os, sys, logging, dialog, PyZenity
+
+sys.path.insert(0, '/opt/NGSmethDB_API_client')
+import NGSmethDB_API_client as client
+
+logger = client.logger
+logger.addHandler(logging.StreamHandler())
 
 display = 'DISPLAY' in os.environ
-local = [int(i) for i in str(subprocess.Popen(['python3', '/opt/NGSmethDB_API_client/NGSmethDB_API_client.py', '--version'], stdout = subprocess.PIPE).communicate()[0]).strip().split(' ')[-1][:-3].split('.')]
-url = 'http://bioinfo2.ugr.es:8888/NGSmethAPI/version'
-n = 0
-while True:
-    try:
-        res = requests.get(url)
-        break
-    except:
-        n += 1
-        if n < retries:
-            logger.warning('Internet connection failed. Retrying...')
-        else:
-            logger.critical('Unable to connect to the Internet! Leaving the program...')
-            raise SystemExit
-if res.status_code != 200:
-    logger.error('API Error: ' + str(res.status_code))
+local = [int(i) for i in client.__version__.split('.')]
+try:
+    remote = client.NGSmethDBClient(catalog_dir = client.DEFAULT_CATALOG_DIR).version()
+except client.APIError as error:
+    logger.error(str(error))
     logger.critical('Unable to reach the NGSmethDB API Server! Leaving the program...')
     raise SystemExit
-data = res.json()
-remote = data[0]['NGSmethDB_API_client']
 changes = local < remote
 
 if changes: